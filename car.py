@@ -1,5 +1,130 @@
 
 import numpy as np
+from integrators import Event, SemiImplicitEuler, step_with_events
+from powertrain import Powertrain, TorqueMap
+from wheel_kinematics import WheelKinematics
+
+
+# The car state is packed as [pos_x, pos_y, yaw, vel_x, vel_y] for the
+# integrators. The yaw rate is an algebraic function of the velocity rather
+# than an integrated quantity, so yaw is advanced together with the
+# velocities in the partitioned schemes.
+VELOCITY_MASK = np.array([False, False, True, True, True])
+# The derivatives of pos_x and pos_y are vel_x and vel_y
+POSITIONS_FROM_VELOCITIES = np.array([3, 4])
+
+
+def _car_dynamics(car, yaw, vel_x, vel_y):
+    """Returns (acc_x, acc_y, yaw_rate, motor_force) for the given pose and the
+    car's current inputs. Works on scalars (Car) and on arrays (CarBatch)."""
+    cos_yaw = np.cos(yaw)
+    sin_yaw = np.sin(yaw)
+    lat_vel = cos_yaw * vel_x + sin_yaw * vel_y
+    long_vel = -sin_yaw * vel_x + cos_yaw * vel_y
+
+    # Steering
+    tan_steering = np.tan(car._steering_angle)
+    a_lat = tan_steering * long_vel**2 / car._wheel_base
+
+    # Motor, the drive torque is cut while a shift is in progress
+    throttle = np.where(car._shift_timer > 0, 0, car._throttle)
+    motor_force, _ = car.powertrain.wheel_force(long_vel, throttle, car._gear)
+
+    # Brakes
+    long_sign = np.sign(long_vel)
+    brake_force = -car._brake * car._max_braking_torque / car._wheel_radius * long_sign
+
+    # Aerodynamics
+    drag_force = -0.5 * car._drag_coefficient * car._frontal_area * long_vel**2 * long_sign
+    a_lon = (motor_force + brake_force + drag_force) / car._mass
+
+    yaw_rate = long_vel / car._wheel_base * tan_steering
+
+    acc_x = cos_yaw * a_lat - sin_yaw * a_lon
+    acc_y = sin_yaw * a_lat + cos_yaw * a_lon
+    return acc_x, acc_y, yaw_rate, motor_force
+
+
+def _car_derivative(car, y):
+    acc_x, acc_y, yaw_rate, _ = _car_dynamics(car, y[..., 2], y[..., 3], y[..., 4])
+    return np.stack([y[..., 3], y[..., 4], yaw_rate, acc_x, acc_y], axis=-1)
+
+
+def _long_vel(y):
+    return -np.sin(y[..., 2]) * y[..., 3] + np.cos(y[..., 2]) * y[..., 4]
+
+
+# The car frame has x pointing right and y pointing forward, matching the
+# lateral and longitudinal velocities in _car_dynamics. WheelKinematics uses
+# x forward and y left, and steers the other way round.
+
+def _to_wheel_frame(vectors):
+    return np.stack([vectors[..., 1], -vectors[..., 0]], axis=-1)
+
+
+def _from_wheel_frame(vectors):
+    return np.stack([-vectors[..., 1], vectors[..., 0]], axis=-1)
+
+
+def _wheel_kinematics(car):
+    """WheelKinematics for the wheels FL, FR, RL, RR, front wheels steered."""
+    half_base = car._wheel_base / 2
+    half_width = car._width / 2
+    positions = [
+        [half_base, half_width],
+        [half_base, -half_width],
+        [-half_base, half_width],
+        [-half_base, -half_width],
+    ]
+    return WheelKinematics(positions, car._wheel_radius, steered=[True, True, False, False])
+
+
+def _wheel_turning_angles(car, yaw, steering_angle):
+    """World frame heading angle of every wheel, shape (..., 4)."""
+    # TODO: Account for Ackermann steering
+    steering = np.where(car._wheels.steered, np.asarray(steering_angle)[..., None], 0)
+    return np.asarray(yaw)[..., None] + steering
+
+
+def _wheel_to_world(yaw, vectors):
+    """Rotates (..., 4, 2) wheel frame vectors of cars at yaw to the world frame."""
+    cos_yaw = np.cos(yaw)[..., None]
+    sin_yaw = np.sin(yaw)[..., None]
+    forward = vectors[..., 0]
+    left = vectors[..., 1]
+    return np.stack([-sin_yaw * forward - cos_yaw * left, cos_yaw * forward - sin_yaw * left], axis=-1)
+
+
+def _wheel_state(car):
+    """Returns (body_vel, center_velocities, wheel_speed) in the wheel frame.
+
+    Computed on first use after the state or steering changed and cached
+    until then, so update() does not pay for wheel quantities nobody reads.
+    The wheels have no inertia in this model, they roll without longitudinal
+    slip, so the wheel speed is the rolling speed of the wheel center."""
+    if car._wheel_cache is None:
+        yaw = car._yaw
+        vel = car._vel
+        lat_vel = np.cos(yaw) * vel[..., 0] + np.sin(yaw) * vel[..., 1]
+        long_vel = -np.sin(yaw) * vel[..., 0] + np.cos(yaw) * vel[..., 1]
+        body_vel = np.stack([long_vel, -lat_vel], axis=-1)
+        center_velocities = car._wheels.center_velocity(body_vel, car._yaw_rate)
+        headings = car._wheels.heading(-np.asarray(car._steering_angle))
+        wheel_speed = np.sum(center_velocities * headings, axis=-1) / car._wheel_radius
+        car._wheel_cache = (body_vel, center_velocities, wheel_speed)
+    return car._wheel_cache
+
+
+def _wheel_contact_point_velocities(car):
+    body_vel, _, wheel_speed = _wheel_state(car)
+    slip_velocity = car._wheels.slip_velocity(body_vel, car._yaw_rate, wheel_speed, -np.asarray(car._steering_angle))
+    return _wheel_to_world(car._yaw, slip_velocity)
+
+
+def _car_position_derivative(car, y):
+    derivative = np.zeros_like(y)
+    derivative[..., 0:2] = y[..., 3:5]
+    return derivative
 
 
 class Car:
@@ -15,6 +140,11 @@ class Car:
         self._gear_ratios = 6 / np.arange(1, 6+1) * 2
         self._max_rpm = 8000 # rad/s
         self._max_torque = 500 # Nm
+        self.powertrain = Powertrain(
+            TorqueMap.flat(self._max_torque, self._max_rpm),
+            self._gear_ratios,
+            self._wheel_radius,
+        )
         # self._powertrain_inertia = 10 # kgm^2
         # self._wheel_inertia = 2 # kgm^2
 
@@ -38,7 +168,7 @@ class Car:
         self._yaw = 0
         self._yaw_rate = 0
 
-        # self._wheel_speed = [0, 0, 0, 0] # FL, FR, RL, RR
+        self._wheel_cache = None # see _wheel_state
         self._motor_force = 0
         
         # Driver inputs
@@ -46,45 +176,58 @@ class Car:
         self._throttle = 0
         self._brake = 0
         self._gear = 0
+        self._shift_timer = 0.0
 
         # Traction
         # self._static_friction_coefficient = 0.8
         # self._kinetic_friction_coefficient = 0.6
         # self._slip_velocity_threshold = 1 # m/s
-    
-    def __get_wheel_local_position(self, wheel_index):
-        """Returns the position of the wheel center in the car frame."""
-        return [
-            np.array([self._wheel_base/2, self._width/2]),
-            np.array([self._wheel_base/2, -self._width/2]),
-            np.array([-self._wheel_base/2, self._width/2]),
-            np.array([-self._wheel_base/2, -self._width/2])
-        ][wheel_index]
+
+        # Automatic gearbox, None shifts only through the gear property
+        self.transmission = None
+
+        # Integration scheme and events, see integrators.py
+        self.integrator = SemiImplicitEuler()
+        self.velocity_mask = VELOCITY_MASK
+        self.positions_from_velocities = POSITIONS_FROM_VELOCITIES
+        self.vectorized = True
+        self.events = []
+
+        # Wheel geometry, computed once
+        self._wheels = _wheel_kinematics(self)
+        self._wheel_positions = _from_wheel_frame(self._wheels.positions)
+
+    def get_wheel_local_positions(self):
+        """Returns the (4, 2) wheel center positions in the car frame, rows FL, FR, RL, RR."""
+        return self._wheel_positions
 
     def rotate90(self, vec):
         return np.array([-vec[1], vec[0]])
     
 
+    def get_wheel_turning_angles(self):
+        """Returns the angle of every wheel in the world frame based on the steering angle."""
+        return _wheel_turning_angles(self, self._yaw, self._steering_angle)
+
     def get_wheel_turning_angle(self, wheel_index):
-        """Returns the angle of the wheel in the world frame based on the steering angle."""
-        if wheel_index in [0, 1]:
-            return self._steering_angle + self._yaw # TODO: Account for Ackermann steering
-        return self._yaw
-        
+        return self.get_wheel_turning_angles()[wheel_index]
+
 
+    def get_wheel_center_velocities(self):
+        """Returns the (4, 2) velocities of the wheel centers in the world frame."""
+        return _wheel_to_world(self._yaw, _wheel_state(self)[1])
 
     def get_wheel_center_velocity(self, wheel_index):
-        """Returns the velocity of the wheel center in the world frame."""
-        wheel_local_position = self._get_wheel_local_position(wheel_index)
-        wheel_local_velocity = self._vel + self.rotate90(wheel_local_position) * self._yaw_rate
-        return wheel_local_velocity
+        return self.get_wheel_center_velocities()[wheel_index]
         
         
+    def get_wheel_contact_point_velocities(self):
+        """Returns the (4, 2) velocities of the wheel contact points in the
+        world frame, i.e. the slip velocities of the tires."""
+        return _wheel_contact_point_velocities(self)
+
     def get_wheel_contact_point_velocity(self, wheel_index):
-        """Returns the velocity of the wheel contact point in the world frame."""
-        wheel_local_position = self._get_wheel_local_position(wheel_index)
-        wheel_local_velocity = self._vel + self.rotate90(wheel_local_position) * self._yaw_rate
-        return wheel_local_velocity + self.rotate90(wheel_local_position) * self._wheel_speed[wheel_index]
+        return self.get_wheel_contact_point_velocities()[wheel_index]
 
     def get_rotation_matrix(self):
         return np.array([
@@ -92,41 +235,86 @@ class Car:
             [np.sin(self._yaw), np.cos(self._yaw)]
         ])
     
-    def update(self, dt):
-        
-        local_vel = self.get_rotation_matrix().T @ self._vel
-        lat_vel = local_vel[0]
-        long_vel = local_vel[1]
-
-        # Steering
-        a_lat = np.tan(self._steering_angle) * long_vel**2 / self._wheel_base
+    def reset(self, state=None):
+        """Puts the car back at rest, or at the packed state, with the driver
+        inputs released and the gearbox in first."""
+        self.set_state(np.zeros(5) if state is None else state)
+        self._acc = np.array([0.0, 0.0])
+        self._yaw_rate = 0
+        self._motor_force = 0
+        self._steering_angle = 0
+        self._throttle = 0
+        self._brake = 0
+        self._gear = 0
+        self._shift_timer = 0.0
+
+    def get_state(self):
+        """Returns the packed state [pos_x, pos_y, yaw, vel_x, vel_y]."""
+        return np.array([self._pos[0], self._pos[1], self._yaw, self._vel[0], self._vel[1]])
+
+    def set_state(self, y):
+        self._pos[:] = y[0:2]
+        self._yaw = y[2]
+        self._vel[:] = y[3:5]
+        self._wheel_cache = None
+
+    def derivative(self, t, y):
+        """Time derivative of a packed state with the current driver inputs."""
+        return _car_derivative(self, y)
+
+    def position_derivative(self, t, y):
+        return _car_position_derivative(self, y)
+
+    def get_motor_rpm(self, y):
+        """Motor rpm for a packed state in the current gear."""
+        return self.powertrain.motor_rpm(_long_vel(y), self._gear)
+
+    def shift_event(self, upshift_fraction=0.9):
+        """Shifts up as soon as the rpm rises past upshift_fraction * max_rpm."""
+        def shift(t, y):
+            self.gear = self._gear + 1
+            return y
+        return Event(
+            lambda t, y: upshift_fraction * self._max_rpm - self.get_motor_rpm(y),
+            shift,
+            direction=-1,
+        )
+
+    def rev_limit_event(self):
+        """Stops the step exactly where the rev limiter cuts the motor."""
+        return Event(lambda t, y: self._max_rpm - self.get_motor_rpm(y), direction=-1)
+
+    def stop_event(self):
+        """Brings the car to rest where the longitudinal speed crosses zero
+        under braking, instead of letting the brake force chatter around it."""
+        def stop(t, y):
+            if self._brake > 0 and self._throttle == 0:
+                y = y.copy()
+                y[3:5] = 0
+            return y
+        return Event(lambda t, y: _long_vel(y), stop)
 
-        # Motor
-        motor_rpm = self.motor_rpm
-    
-        if motor_rpm > self._max_rpm:
-            self._motor_force = 0
+    def update(self, dt):
+        if self.transmission is not None:
+            gear, shift_timer = self.transmission.update(
+                self._gear, self._shift_timer, _long_vel(self.get_state()), self._brake, dt
+            )
+            self._gear = int(gear)
+            self._shift_timer = float(shift_timer)
+
+        acc_x, acc_y, yaw_rate, motor_force = _car_dynamics(
+            self, self._yaw, self._vel[0], self._vel[1]
+        )
+        self._acc = np.array([acc_x, acc_y])
+        self._yaw_rate = float(yaw_rate)
+        self._motor_force = float(motor_force)
+
+        dydt = np.array([self._vel[0], self._vel[1], self._yaw_rate, acc_x, acc_y])
+        if self.events:
+            y, _ = step_with_events(self.integrator, self, 0, self.get_state(), dt, self.events, dydt)
         else:
-            motor_torque = self._throttle * self._max_torque
-            self._motor_force = motor_torque / self._wheel_radius * self._gear_ratios[self._gear]
-
-        # Brakes
-        brake_force = -self._brake * self._max_braking_torque / self._wheel_radius * np.sign(long_vel)
-
-        # Aerodynamics
-        drag_force = -0.5 * self._drag_coefficient * self._frontal_area * long_vel**2 * np.sign(long_vel)
-        a_lon = (self._motor_force + brake_force + drag_force) / self._mass
-
-        
-        self._yaw_rate = long_vel / self._wheel_base * np.tan(self._steering_angle)
-
-        local_acc = np.array([a_lat, a_lon])
-        self._acc = self.get_rotation_matrix() @ local_acc
-
-        self._vel += self._acc * dt
-        self._pos += self._vel * dt
-
-        self._yaw += self._yaw_rate * dt
+            y = self.integrator.step(self, 0, self.get_state(), dt, dydt)
+        self.set_state(y)
 
         
     @property
@@ -148,6 +336,11 @@ class Car:
     @property
     def yaw_rate(self):
         return self._yaw_rate
+
+    @property
+    def wheel_speed(self):
+        """Rolling speed of every wheel in rad/s, FL, FR, RL, RR."""
+        return _wheel_state(self)[2]
     
     @property
     def steering_angle(self):
@@ -157,6 +350,7 @@ class Car:
     def steering_angle(self, value):
         value = np.clip(value, -1, 1) * np.pi / 4
         self._steering_angle = value
+        self._wheel_cache = None
 
     @property
     def throttle(self):
@@ -180,13 +374,12 @@ class Car:
     
     @gear.setter
     def gear(self, value):
-        self._gear = np.clip(value, 0, len(self._gear_ratios) - 1).astype(int)
+        self._gear = int(min(max(value, 0), len(self._gear_ratios) - 1))
 
     
     @property
     def motor_rpm(self):
-        long_vel = (self.get_rotation_matrix().T @ self._vel)[1]
-        return long_vel / self._wheel_radius * self._gear_ratios[self._gear] * 60 / (2 * np.pi)
+        return self.get_motor_rpm(self.get_state())
     
 
     @property
@@ -204,7 +397,222 @@ class Car:
 
 
 
+class CarBatch:
+    """Structure-of-arrays version of Car that advances N cars at once.
+
+    Every state variable and driver input is stored as a contiguous array with
+    one entry per car, and update() applies the same physics as Car.update
+    to all of them with vectorized NumPy operations.
+    """
+
+    def __init__(self, n, car=None):
+
+        # Vehicle parameters are shared by all cars in the batch and copied
+        # from a template car so the two classes never drift apart.
+        if car is None:
+            car = Car()
+        self._n = n
+
+        self._wheel_base = car._wheel_base
+        self._wheel_radius = car._wheel_radius
+        self._width = car._width
+        self._length = car._length
+
+        self._gear_ratios = np.asarray(car._gear_ratios, dtype=float)
+        self._max_rpm = car._max_rpm
+        self._max_torque = car._max_torque
+        self.powertrain = car.powertrain
+
+        self._mass = car._mass
+
+        self._frontal_area = car._frontal_area
+        self._drag_coefficient = car._drag_coefficient
 
+        self._max_braking_torque = car._max_braking_torque
 
+        self._wheels = car._wheels
+        self._wheel_positions = car._wheel_positions
 
+        # State variables. Position, yaw and velocity are views into one
+        # (n, 5) block packed the same way as Car.get_state, which is what the
+        # integrator advances.
+        self._state = np.zeros((n, 5))
+        self._pos = self._state[:, 0:2]
+        self._yaw = self._state[:, 2]
+        self._vel = self._state[:, 3:5]
+        self._acc = np.zeros((n, 2))
 
+        # Derivative buffer reused by every update
+        self._derivative = np.zeros((n, 5))
+
+        self._yaw_rate = np.zeros(n)
+
+        self._wheel_cache = None
+        self._motor_force = np.zeros(n)
+
+        # Driver inputs
+        self._steering_angle = np.zeros(n)
+        self._throttle = np.zeros(n)
+        self._brake = np.zeros(n)
+        self._gear = np.zeros(n, dtype=int)
+        self._shift_timer = np.zeros(n)
+
+        self.transmission = car.transmission
+        self.integrator = car.integrator
+        self.velocity_mask = VELOCITY_MASK
+        self.positions_from_velocities = POSITIONS_FROM_VELOCITIES
+        self.vectorized = True
+
+    def __len__(self):
+        return self._n
+
+    def get_local_velocity(self):
+        """Returns the (lateral, longitudinal) velocity of every car in its own frame."""
+        cos_yaw = np.cos(self._yaw)
+        sin_yaw = np.sin(self._yaw)
+        lat_vel = cos_yaw * self._vel[:, 0] + sin_yaw * self._vel[:, 1]
+        long_vel = -sin_yaw * self._vel[:, 0] + cos_yaw * self._vel[:, 1]
+        return lat_vel, long_vel
+
+    def get_wheel_local_positions(self):
+        """Returns the (4, 2) wheel positions in the car frame, shared by all cars."""
+        return self._wheel_positions
+
+    def get_wheel_turning_angles(self):
+        """Returns the (n, 4) world frame wheel angles."""
+        return _wheel_turning_angles(self, self._yaw, self._steering_angle)
+
+    def get_wheel_center_velocities(self):
+        """Returns the (n, 4, 2) world frame wheel center velocities."""
+        return _wheel_to_world(self._yaw, _wheel_state(self)[1])
+
+    def get_wheel_contact_point_velocities(self):
+        """Returns the (n, 4, 2) world frame wheel contact point velocities."""
+        return _wheel_contact_point_velocities(self)
+
+    def reset(self, mask=None, state=None):
+        """Resets the cars selected by the boolean mask (all when None), see
+        Car.reset. state is a packed state, or one per selected car."""
+        if mask is None:
+            mask = slice(None)
+        self._state[mask] = 0 if state is None else state
+        self._acc[mask] = 0
+        self._yaw_rate[mask] = 0
+        self._wheel_cache = None
+        self._motor_force[mask] = 0
+        self._steering_angle[mask] = 0
+        self._throttle[mask] = 0
+        self._brake[mask] = 0
+        self._gear[mask] = 0
+        self._shift_timer[mask] = 0
+
+    def get_state(self):
+        """Returns the packed (n, 5) state, see Car.get_state."""
+        return self._state.copy()
+
+    def set_state(self, y):
+        self._state[:] = y
+        self._wheel_cache = None
+
+    def derivative(self, t, y):
+        return _car_derivative(self, y)
+
+    def position_derivative(self, t, y):
+        return _car_position_derivative(self, y)
+
+    def update(self, dt):
+        if self.transmission is not None:
+            self._gear[:], self._shift_timer[:] = self.transmission.update(
+                self._gear, self._shift_timer, self.get_local_velocity()[1], self._brake, dt
+            )
+
+        acc_x, acc_y, yaw_rate, motor_force = _car_dynamics(
+            self, self._yaw, self._vel[:, 0], self._vel[:, 1]
+        )
+        self._acc[:, 0] = acc_x
+        self._acc[:, 1] = acc_y
+        self._yaw_rate[:] = yaw_rate
+        self._motor_force[:] = motor_force
+
+        dydt = self._derivative
+        dydt[:, 0] = self._vel[:, 0]
+        dydt[:, 1] = self._vel[:, 1]
+        dydt[:, 2] = yaw_rate
+        dydt[:, 3] = acc_x
+        dydt[:, 4] = acc_y
+        self._state[:] = self.integrator.step(self, 0, self._state, dt, dydt)
+        self._wheel_cache = None
+
+    @property
+    def pos(self):
+        return self._pos
+
+    @property
+    def vel(self):
+        return self._vel
+
+    @property
+    def acc(self):
+        return self._acc
+
+    @property
+    def yaw(self):
+        return self._yaw
+
+    @property
+    def yaw_rate(self):
+        return self._yaw_rate
+
+    @property
+    def wheel_speed(self):
+        """Rolling speed of every wheel in rad/s, FL, FR, RL, RR."""
+        return _wheel_state(self)[2]
+
+    @property
+    def steering_angle(self):
+        return self._steering_angle
+
+    @steering_angle.setter
+    def steering_angle(self, value):
+        self._steering_angle[:] = np.clip(value, -1, 1) * np.pi / 4
+        self._wheel_cache = None
+
+    @property
+    def throttle(self):
+        return self._throttle
+
+    @throttle.setter
+    def throttle(self, value):
+        self._throttle[:] = np.clip(value, 0, 1)
+
+    @property
+    def brake(self):
+        return self._brake
+
+    @brake.setter
+    def brake(self, value):
+        self._brake[:] = np.clip(value, 0, 1)
+
+    @property
+    def gear(self):
+        return self._gear
+
+    @gear.setter
+    def gear(self, value):
+        self._gear[:] = np.clip(value, 0, len(self._gear_ratios) - 1)
+
+    @property
+    def motor_rpm(self):
+        return self.powertrain.motor_rpm(self.get_local_velocity()[1], self._gear)
+
+    @property
+    def max_rpm(self):
+        return self._max_rpm
+
+    @property
+    def max_torque(self):
+        return self._max_torque
+
+    @property
+    def motor_force(self):
+        return self._motor_force
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+def _to_world(local_points, pos, yaw):
+    """Transforms (K, 2) car frame points to the world frame for every car,
+    giving shape (..., K, 2). The car frame has x right and y forward."""
+    cos_yaw = np.cos(yaw)[..., None]
+    sin_yaw = np.sin(yaw)[..., None]
+    x = local_points[:, 0]
+    y = local_points[:, 1]
+    world = np.stack([cos_yaw * x - sin_yaw * y, sin_yaw * x + cos_yaw * y], axis=-1)
+    return world + np.asarray(pos)[..., None, :]
+
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def footprint_corners(pos, yaw, length, width):
+    """Corners of the oriented car rectangles, shape (..., 4, 2), ordered
+    front left, front right, rear right, rear left."""
+    half_length = length / 2
+    half_width = width / 2
+    local = np.array([
+        [-half_width, half_length],
+        [half_width, half_length],
+        [half_width, -half_length],
+        [-half_width, -half_length],
+    ])
+    return _to_world(local, pos, yaw)
+
+
+class TrackLimits:
+    """Off-track and boundary penetration checks for the car footprint.
+
+    The corners and wheel centers of all cars are projected onto the
+    centerline in one Track.project call, which goes through the track's
+    segment grid instead of scanning the boundaries. Every point is then
+    measured against the left and right boundary segments alongside its
+    centerline segment: the depth is the perpendicular distance past the
+    line of that boundary segment. This follows the boundary polylines
+    themselves rather than the centerline offset, but it is not the exact
+    distance to the polylines: just outside a boundary corner it measures
+    to the line of one segment instead of to the corner point.
+
+    A car is off track when all four wheels are beyond the boundaries, and
+    the penetration depth is how far the footprint reaches past them.
+    """
+
+    def __init__(self, track, length, width, wheel_positions) -> None:
+        self.track = track
+        self.length = length
+        self.width = width
+        self.wheel_positions = np.asarray(wheel_positions, dtype=float)
+
+        # Boundary segment k runs alongside centerline segment k
+        self._left_starts = track.left_boundary[:-1]
+        self._right_starts = track.right_boundary[:-1]
+        left = np.diff(track.left_boundary, axis=0)
+        right = np.diff(track.right_boundary, axis=0)
+        self._left_directions = left / np.linalg.norm(left, axis=-1, keepdims=True)
+        self._right_directions = right / np.linalg.norm(right, axis=-1, keepdims=True)
+
+
+    @classmethod
+    def from_car(cls, track, car):
+        return cls(track, car._length, car._width, car._wheel_positions)
+
+
+    def footprint(self, pos, yaw):
+        return footprint_corners(pos, yaw, self.length, self.width)
+
+
+    def wheels(self, pos, yaw):
+        """World frame wheel centers, shape (..., 4, 2)."""
+        return _to_world(self.wheel_positions, pos, yaw)
+
+
+    def excess(self, points):
+        """Distance of every point past the boundary segment lines alongside
+        it, negative while the point is on the track."""
+        points = np.asarray(points, dtype=float)
+        segment = self.track.project(points)[2]
+        # Signed distances from the boundary lines, positive to the left
+        left = _cross(self._left_directions[segment], points - self._left_starts[segment])
+        right = _cross(self._right_directions[segment], points - self._right_starts[segment])
+        return np.maximum(left, -right)
+
+
+    def check(self, pos, yaw):
+        """Returns (off_track, wheels_off, penetration) for cars at pos
+        (..., 2) and yaw (...): whether all wheels are off the track, the
+        number of wheels beyond the boundaries and the deepest footprint
+        corner penetration, zero while the footprint is on the track."""
+        points = np.concatenate([self.footprint(pos, yaw), self.wheels(pos, yaw)], axis=-2)
+        excess = self.excess(points)
+        wheels_off = np.count_nonzero(excess[..., 4:] > 0, axis=-1)
+        penetration = np.maximum(excess[..., :4].max(axis=-1), 0)
+        return wheels_off == len(self.wheel_positions), wheels_off, penetration
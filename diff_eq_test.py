@@ -1,22 +1,23 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
+from integrators import ExplicitEuler, RungeKutta4
 
 k=-1
 f = lambda y: k*y
 
 
+class Decay:
+    def derivative(self, t, y):
+        return f(y)
+
 
 def euler(all_y, h):
-    return all_y[-1] + h*f(all_y[-1])
+    return ExplicitEuler().step(Decay(), 0, all_y[-1], h)
 
 
 def runge_kutta(all_y, h):
-    k1 = f(all_y[-1])
-    k2 = f(all_y[-1] + h/2*k1)
-    k3 = f(all_y[-1] + h/2*k2)
-    k4 = f(all_y[-1] + h*k3)
-    return all_y[-1] + h/6*(k1 + 2*k2 + 2*k3 + k4)
+    return RungeKutta4().step(Decay(), 0, all_y[-1], h)
 
 
 t_max = 10
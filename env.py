@@ -0,0 +1,269 @@
+import numpy as np
+from car import Car, CarBatch
+from collision import TrackLimits
+from powertrain import Transmission
+
+
+# Observations are in the car frame so the policy does not depend on where
+# the car is or which way it points.
+OBSERVATION_NAMES = (
+    "lat_vel",
+    "long_vel",
+    "yaw_rate",
+    "rpm_fraction",
+    "gear_fraction",
+    "steering_angle",
+)
+
+# Actions are [steering, throttle, brake] in [-1, 1] x [0, 1] x [0, 1]
+ACTION_SIZE = 3
+
+
+def _local_velocity(car):
+    vel = car._vel
+    cos_yaw = np.cos(car._yaw)
+    sin_yaw = np.sin(car._yaw)
+    lat_vel = cos_yaw * vel[..., 0] + sin_yaw * vel[..., 1]
+    long_vel = -sin_yaw * vel[..., 0] + cos_yaw * vel[..., 1]
+    return lat_vel, long_vel
+
+
+def _write_observation(car, out, lidar=None, mask=Ellipsis, ranges=None):
+    """Writes the observation of a Car into out[(obs_dim)] or of a CarBatch
+    into out[(n, obs_dim)]. The lidar ranges, as fractions of the maximum
+    range, follow the named observations. mask selects the cars of a
+    CarBatch to write, the other rows of out are left alone. ranges, of
+    shape (K) or (n, K), is a buffer the lidar is cast into."""
+    def rows(value):
+        return np.asarray(value)[mask]
+
+    if lidar is not None:
+        yaw = rows(car._yaw)
+        if ranges is not None and yaw.ndim:
+            ranges = ranges[:len(yaw)]
+        ranges = lidar.cast(rows(car._pos), yaw, out=ranges)
+        ranges /= lidar.max_range
+        out[mask, len(OBSERVATION_NAMES):] = ranges
+    lat_vel, long_vel = _local_velocity(car)
+    out[mask, 0] = rows(lat_vel)
+    out[mask, 1] = rows(long_vel)
+    out[mask, 2] = rows(car._yaw_rate)
+    out[mask, 3] = rows(car.motor_rpm) / car._max_rpm
+    out[mask, 4] = rows(car._gear) / (len(car._gear_ratios) - 1)
+    out[mask, 5] = rows(car._steering_angle)
+    return out
+
+
+def _apply_action(car, action):
+    action = np.asarray(action, dtype=float)
+    car.steering_angle = action[..., 0]
+    car.throttle = action[..., 1]
+    car.brake = action[..., 2]
+
+
+def _reward(car, dt):
+    # Distance covered in the direction the car is pointing
+    return _local_velocity(car)[1] * dt
+
+
+def _start_state(track):
+    """Packed car state at rest on the start line, pointing along the track.
+    The car's forward axis is its local y, hence the quarter turn."""
+    if track is None:
+        return None
+    return np.r_[track.position(0), track.heading(0) - np.pi / 2, 0, 0]
+
+
+def _track_step(limits, pos, yaw, previous_progress, diverged):
+    """Returns (progress, progress_delta, off_track, penetration). Diverged
+    cars keep their progress, count as off track and get no penalty; their
+    non-finite poses are never projected."""
+    track = limits.track
+    if np.any(diverged):
+        pos = np.where(diverged[..., None], track.points[0], pos)
+        yaw = np.where(diverged, 0, yaw)
+    progress = track.project(pos)[0]
+    delta = progress - previous_progress
+    if track.closed:
+        # Crossing the start line is progress, not a lap backwards
+        delta = np.mod(delta + track.length / 2, track.length) - track.length / 2
+    off_track, _, penetration = limits.check(pos, yaw)
+    progress = np.where(diverged, previous_progress, progress)
+    delta = np.where(diverged, 0, delta)
+    off_track = off_track | diverged
+    penetration = np.where(diverged, 0, penetration)
+    return progress, delta, off_track, penetration
+
+
+def _terminated(car):
+    # A diverged integration cannot be recovered from
+    return ~np.all(np.isfinite(car._state if isinstance(car, CarBatch) else car.get_state()), axis=-1)
+
+
+class CarEnv:
+    """Gym-style environment around a single Car.
+
+    reset() returns (observation, info) and step(action) returns
+    (observation, reward, terminated, truncated, info). An episode is
+    truncated after max_steps steps and terminated if the state diverges.
+
+    Without a track the reward is the distance driven forward. With a track
+    the car starts on the start line, the reward is the progress along the
+    centerline minus off_track_penalty times the footprint penetration past
+    the boundaries, and leaving the track with all wheels ends the episode.
+    A sensors.Lidar adds its ray distances to the observation.
+    """
+
+    def __init__(
+            self,
+            car=None,
+            dt=0.1,
+            max_steps=1000,
+            automatic_gearbox=True,
+            track=None,
+            off_track_penalty=1.0,
+            lidar=None,
+            ) -> None:
+        self.car = Car() if car is None else car
+        if automatic_gearbox and self.car.transmission is None:
+            self.car.transmission = Transmission(self.car.powertrain)
+        self.dt = dt
+        self.max_steps = max_steps
+        self.lidar = lidar
+        self.observation_size = len(OBSERVATION_NAMES) + (0 if lidar is None else len(lidar))
+        self.action_size = ACTION_SIZE
+        self.steps = 0
+        self._ranges = None if lidar is None else np.empty(len(lidar))
+
+        self.track = track
+        self.limits = None if track is None else TrackLimits.from_car(track, self.car)
+        self.off_track_penalty = off_track_penalty
+        self.start_state = _start_state(track)
+        self.progress = 0.0
+
+
+    def observe(self):
+        return _write_observation(self.car, np.zeros(self.observation_size), self.lidar, ranges=self._ranges)
+
+
+    def reset(self, state=None):
+        self.car.reset(self.start_state if state is None else state)
+        self.steps = 0
+        if self.track is not None:
+            self.progress = float(self.track.project(self.car.pos)[0])
+        return self.observe(), {}
+
+
+    def step(self, action):
+        _apply_action(self.car, action)
+        self.car.update(self.dt)
+        self.steps += 1
+
+        diverged = _terminated(self.car)
+        terminated = bool(diverged)
+        if self.track is None:
+            reward = float(_reward(self.car, self.dt))
+        else:
+            progress, delta, off_track, penetration = _track_step(
+                self.limits, self.car.pos, self.car.yaw, self.progress, diverged
+            )
+            self.progress = float(progress)
+            reward = float(delta - self.off_track_penalty * penetration)
+            terminated = terminated or bool(off_track)
+        truncated = self.steps >= self.max_steps
+        return self.observe(), reward, terminated, truncated, {}
+
+
+class VectorCarEnv:
+    """N independent car environments stepped in one vectorized call.
+
+    Observations, rewards and done flags live in preallocated arrays that are
+    overwritten by every step, so callers that keep them must copy. Finished
+    environments are reset inside step() through boolean masks: the
+    observations returned for them are already the first observations of the
+    next episode, and the last observations of the finished episode are in
+    info["final_observation"].
+
+    Rewards and termination follow CarEnv, including the optional track.
+    """
+
+    def __init__(
+            self,
+            n,
+            car=None,
+            dt=0.1,
+            max_steps=1000,
+            automatic_gearbox=True,
+            track=None,
+            off_track_penalty=1.0,
+            lidar=None,
+            ) -> None:
+        self.cars = CarBatch(n, car)
+        if automatic_gearbox and self.cars.transmission is None:
+            self.cars.transmission = Transmission(self.cars.powertrain)
+        self.n = n
+        self.dt = dt
+        self.max_steps = max_steps
+        self.lidar = lidar
+        self.observation_size = len(OBSERVATION_NAMES) + (0 if lidar is None else len(lidar))
+        self.action_size = ACTION_SIZE
+
+        self.observations = np.zeros((n, self.observation_size))
+        self.final_observations = np.zeros((n, self.observation_size))
+        self._ranges = None if lidar is None else np.empty((n, len(lidar)))
+        self.rewards = np.zeros(n)
+        self.terminated = np.zeros(n, dtype=bool)
+        self.truncated = np.zeros(n, dtype=bool)
+        self.dones = np.zeros(n, dtype=bool)
+        self.steps = np.zeros(n, dtype=int)
+
+        self.track = track
+        self.limits = None if track is None else TrackLimits.from_car(track, self.cars)
+        self.off_track_penalty = off_track_penalty
+        self.start_state = _start_state(track)
+        self.progress = np.zeros(n)
+
+
+    def __len__(self):
+        return self.n
+
+
+    def reset(self, mask=None, state=None):
+        """Resets the environments selected by mask (all when None)."""
+        mask = slice(None) if mask is None else mask
+        self.cars.reset(mask, self.start_state if state is None else state)
+        self.steps[mask] = 0
+        if self.track is not None:
+            self.progress[mask] = self.track.project(self.cars.pos[mask])[0]
+        _write_observation(self.cars, self.observations, self.lidar, mask, self._ranges)
+        return self.observations, {}
+
+
+    def step(self, actions):
+        cars = self.cars
+        _apply_action(cars, actions)
+        cars.update(self.dt)
+        self.steps += 1
+
+        self.terminated[:] = _terminated(cars)
+        if self.track is None:
+            self.rewards[:] = _reward(cars, self.dt)
+        else:
+            progress, delta, off_track, penetration = _track_step(
+                self.limits, cars.pos, cars.yaw, self.progress, self.terminated
+            )
+            self.progress[:] = progress
+            self.rewards[:] = delta - self.off_track_penalty * penetration
+            self.terminated |= off_track
+        np.greater_equal(self.steps, self.max_steps, out=self.truncated)
+        np.logical_or(self.terminated, self.truncated, out=self.dones)
+        _write_observation(cars, self.observations, self.lidar, ranges=self._ranges)
+
+        dones = self.dones
+        if dones.any():
+            self.final_observations[dones] = self.observations[dones]
+            # Rewrites the observations of the reset environments
+            self.reset(dones)
+
+        info = {"final_observation": self.final_observations}
+        return self.observations, self.rewards, self.terminated, self.truncated, info
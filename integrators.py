@@ -0,0 +1,577 @@
+import numpy as np
+
+
+# Integration schemes shared by the Car models and PhysicsSystem simulations.
+#
+# A simulated system only has to provide derivative(t, y), which returns dy/dt
+# for the flat state array y. The state may have leading batch dimensions, the
+# integrators only ever index the last axis.
+#
+# The partitioned schemes (semi-implicit Euler and leapfrog) also need
+# system.velocity_mask, a boolean mask over the last axis marking the velocity
+# entries. Those are advanced first and the remaining (position) entries are
+# then advanced using the updated velocities. If the system has a
+# position_derivative(t, y) method it is used for that second evaluation,
+# otherwise derivative(t, y) is called again. A system whose position
+# derivatives are plain copies of velocity entries can instead provide
+# system.positions_from_velocities, the index of the velocity entry of each
+# position entry (in order), and the positions are advanced from those
+# entries without evaluating anything.
+#
+# Every step() accepts the derivative at (t, y) as dydt when the caller has
+# already computed it, so it is not evaluated twice.
+#
+# MultiRateIntegrator advances groups of entries at different rates, each
+# with one of the schemes above. DormandPrince chooses its own step sizes
+# and integrates over an interval instead of taking single steps.
+#
+# Discrete changes (gear shifts, stopping, rev limits) are handled with
+# Events, zero crossing functions that step_with_events and DormandPrince
+# locate inside a step instead of relying on a small dt.
+#
+# The implicit schemes linearize the system. They use system.jacobian(t, y)
+# when it exists and finite differences otherwise, restricted to
+# system.state_index (the integrated entries of y, all of them by default).
+# If system.vectorized is true, derivative() also accepts extra leading axes
+# and all the finite difference perturbations are evaluated in one call.
+
+
+class Integrator:
+    """Advances a system by one step of size dt."""
+
+    def step(self, system, t, y, dt, dydt=None):
+        raise NotImplementedError
+
+
+def _velocity_partition(system):
+    """Returns the (velocity, position) entries of system.velocity_mask as
+    index arrays. Integer indexing is cheaper than indexing with the boolean
+    mask and its complement; slices are not, the car states are rows of only
+    5 entries, so a slice turns every update into one tiny inner loop per
+    row."""
+    mask = np.asarray(system.velocity_mask)
+    return np.flatnonzero(mask), np.flatnonzero(~mask)
+
+
+def _advance_positions(system, t, y, dt, position):
+    """Advances the position entries of y in place, using its velocities."""
+    velocity = getattr(system, "positions_from_velocities", None)
+    if velocity is None:
+        y[..., position] += dt * _position_derivative(system, t, y)[..., position]
+    else:
+        y[..., position] += dt * y[..., velocity]
+
+
+def _position_derivative(system, t, y):
+    if hasattr(system, "position_derivative"):
+        return system.position_derivative(t, y)
+    return system.derivative(t, y)
+
+
+class ExplicitEuler(Integrator):
+
+    def step(self, system, t, y, dt, dydt=None):
+        if dydt is None:
+            dydt = system.derivative(t, y)
+        return y + dt * dydt
+
+
+class SemiImplicitEuler(Integrator):
+    """Symplectic Euler: velocities are updated first, positions are then
+    updated with the new velocities. Same cost as explicit Euler but far more
+    stable for oscillating systems."""
+
+    def step(self, system, t, y, dt, dydt=None):
+        if dydt is None:
+            dydt = system.derivative(t, y)
+        velocity, position = _velocity_partition(system)
+        y_new = y.copy()
+        y_new[..., velocity] += dt * dydt[..., velocity]
+        _advance_positions(system, t, y_new, dt, position)
+        return y_new
+
+
+class Leapfrog(Integrator):
+    """Kick-drift-kick leapfrog (velocity Verlet)."""
+
+    def step(self, system, t, y, dt, dydt=None):
+        if dydt is None:
+            dydt = system.derivative(t, y)
+        velocity, position = _velocity_partition(system)
+        y_new = y.copy()
+        y_new[..., velocity] += dt / 2 * dydt[..., velocity]
+        _advance_positions(system, t + dt / 2, y_new, dt, position)
+        y_new[..., velocity] += dt / 2 * system.derivative(t + dt, y_new)[..., velocity]
+        return y_new
+
+
+class RungeKutta4(Integrator):
+    """Classic fourth order Runge-Kutta."""
+
+    def step(self, system, t, y, dt, dydt=None):
+        k1 = system.derivative(t, y) if dydt is None else dydt
+        k2 = system.derivative(t + dt / 2, y + dt / 2 * k1)
+        k3 = system.derivative(t + dt / 2, y + dt / 2 * k2)
+        k4 = system.derivative(t + dt, y + dt * k3)
+        return y + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+def finite_difference_jacobian(system, t, y, dydt, index):
+    """Forward difference Jacobian of dydt[..., index] with respect to
+    y[..., index]. Returns an array of shape y.shape[:-1] + (m, m)."""
+    m = len(index)
+    step = np.sqrt(np.finfo(float).eps) * np.maximum(1.0, np.abs(y[..., index]))
+
+    # Perturbed states are stacked on a new leading axis, so per-system
+    # inputs that broadcast against y broadcast against them as well.
+    perturbed = np.repeat(y[None], m, axis=0)
+    for j in range(m):
+        perturbed[j, ..., index[j]] += step[..., j]
+
+    if getattr(system, "vectorized", False):
+        perturbed_dydt = system.derivative(t, perturbed)
+    else:
+        perturbed_dydt = np.stack([system.derivative(t, p) for p in perturbed])
+
+    # difference[j, ..., i] = d f_i / d y_j
+    difference = (perturbed_dydt[..., index] - dydt[..., index]) / np.moveaxis(step, -1, 0)[..., None]
+    return np.moveaxis(difference, 0, -1)
+
+
+class LinearlyImplicitEuler(Integrator):
+    """Linearly implicit (Rosenbrock) Euler.
+
+    One Newton iteration of backward Euler around the current state:
+
+        (I - dt J) delta = dt f(y),   y_new = y + delta
+
+    It is stable for stiff systems such as the tire slip forces, where the
+    explicit schemes need a very small dt."""
+
+    def step(self, system, t, y, dt, dydt=None):
+        if dydt is None:
+            dydt = system.derivative(t, y)
+        index = getattr(system, "state_index", None)
+        if index is None:
+            index = np.arange(y.shape[-1])
+
+        if hasattr(system, "jacobian"):
+            jacobian = system.jacobian(t, y)
+        else:
+            jacobian = finite_difference_jacobian(system, t, y, dydt, index)
+
+        matrix = np.eye(len(index)) - dt * jacobian
+        delta = np.linalg.solve(matrix, dt * dydt[..., index, None])[..., 0]
+
+        y_new = y.copy()
+        y_new[..., index] += delta
+        return y_new
+
+
+class _Partition:
+    """Restricts a system to a subset of the state entries: the derivative is
+    zero everywhere else, so any integrator leaves the other entries as they
+    are."""
+
+    def __init__(self, system, index):
+        self.system = system
+        self.index = np.asarray(index, dtype=int)
+        self.vectorized = getattr(system, "vectorized", False)
+        if hasattr(system, "velocity_mask"):
+            self.velocity_mask = system.velocity_mask
+        state_index = getattr(system, "state_index", None)
+        if state_index is not None:
+            self.state_index = np.intersect1d(state_index, self.index)
+        else:
+            self.state_index = self.index
+
+    def _restrict(self, derivative):
+        restricted = np.zeros_like(derivative)
+        restricted[..., self.index] = derivative[..., self.index]
+        return restricted
+
+    def derivative(self, t, y):
+        return self._restrict(self.system.derivative(t, y))
+
+    def position_derivative(self, t, y):
+        return self._restrict(_position_derivative(self.system, t, y))
+
+
+class RateGroup:
+    """A group of state entries advanced with substeps steps per outer step.
+
+    system optionally replaces the full system for this group, typically a
+    cheaper one that only solves for the group's own derivatives (see
+    PhysicsDynamics.restrict). integrator optionally replaces the
+    MultiRateIntegrator's default scheme for this group."""
+
+    def __init__(self, index, substeps=1, system=None, integrator=None):
+        self.index = np.asarray(index, dtype=int)
+        self.substeps = substeps
+        self.system = system
+        self.integrator = integrator
+
+
+class MultiRateIntegrator(Integrator):
+    """Multi-rate stepping for systems with fast and slow partitions.
+
+    The groups are advanced from the fastest to the slowest, each with its
+    own substeps over the outer dt. Every substep sees the other groups at
+    the time the substep ends: the groups that were already advanced are
+    interpolated linearly between their start and end values, the slower
+    ones between their start values and a prediction from the derivative at
+    the start of the step (interpolate=False holds the other groups at those
+    end values). So the fast entries never run against stale slow ones, and
+    the slow entries are advanced against where the fast ones ended up.
+    Entries that are not in any group are left unchanged."""
+
+    def __init__(self, groups, integrator=None, interpolate=True):
+        self.groups = sorted(groups, key=lambda group: group.substeps, reverse=True)
+        self.integrator = SemiImplicitEuler() if integrator is None else integrator
+        self.interpolate = interpolate
+
+    def step(self, system, t, y, dt, dydt=None):
+        if dydt is None:
+            dydt = system.derivative(t, y)
+        y_end = y.copy()
+        for group in self.groups:
+            y_end[..., group.index] += dt * dydt[..., group.index]
+
+        for group in self.groups:
+            partition = _Partition(system if group.system is None else group.system, group.index)
+            integrator = self.integrator if group.integrator is None else group.integrator
+            h = dt / group.substeps
+
+            z = y_end.copy()
+            z[..., group.index] = y[..., group.index]
+            for substep in range(group.substeps):
+                if self.interpolate:
+                    own = z[..., group.index]
+                    z = y + (substep + 1) / group.substeps * (y_end - y)
+                    z[..., group.index] = own
+                z = integrator.step(partition, t + substep * h, z, h)
+
+            y_end[..., group.index] = z[..., group.index]
+
+        return y_end
+
+
+class Event:
+    """A zero crossing of function(t, y) that triggers a discrete change.
+
+    When function changes sign inside a step, the integrator locates the
+    crossing and calls action(t, y) there, which returns the new state (and
+    may also change the system, e.g. shift gear). direction restricts the
+    crossings to rising (+1) or falling (-1) ones, 0 accepts both. A terminal
+    event stops the integration. function has to return a scalar, so events
+    are meant for single systems rather than batches."""
+
+    def __init__(self, function, action=None, direction=0, terminal=False):
+        self.function = function
+        self.action = action
+        self.direction = direction
+        self.terminal = terminal
+
+    def crossed(self, g_old, g_new):
+        if self.direction > 0:
+            return g_old < 0 <= g_new and g_new != g_old
+        if self.direction < 0:
+            return g_old > 0 >= g_new and g_new != g_old
+        return (g_old < 0 <= g_new or g_old > 0 >= g_new) and g_new != g_old
+
+    def apply(self, t, y):
+        if self.action is None:
+            return y
+        return self.action(t, y)
+
+
+def _start_value(event, g, state_at, t_old, t_new):
+    """Value of event.function at the start of a step, for the crossing test.
+
+    An action may leave the state on the event surface (g == 0, as a bounce
+    does), where no crossing could ever be seen. Such a start counts as
+    being on the side the event triggers from, the opposite of its
+    direction, or for direction 0 takes the sign just after the start."""
+    if g != 0:
+        return g
+    if event.direction != 0:
+        return -event.direction
+    t_probe = t_old + 1e-3 * (t_new - t_old)
+    return event.function(t_probe, state_at(t_probe))
+
+
+def locate_crossing(event, state_at, t_old, t_new, g_old, tolerance):
+    """Bisects for the first time in (t_old, t_new] where event crosses.
+
+    state_at(t) returns the state at time t. Returns (t, y) on the far side
+    of the crossing, so the event does not trigger again right after."""
+    low, high = t_old, t_new
+    y_high = state_at(high)
+    while high - low > tolerance:
+        middle = 0.5 * (low + high)
+        y_middle = state_at(middle)
+        if event.crossed(g_old, event.function(middle, y_middle)):
+            high, y_high = middle, y_middle
+        else:
+            low = middle
+    return high, y_high
+
+
+def step_with_events(integrator, system, t, y, dt, events, dydt=None, max_events=16):
+    """Takes a step of size dt with integrator, stopping at event crossings.
+
+    Crossings are located by re-stepping from y with shorter steps, the
+    earliest one's action is applied, and the rest of the step is taken from
+    there. Returns (y_new, triggered) where triggered is a list of
+    (event, t) pairs. A terminal event ends the step early; its state is the
+    one returned. At most max_events crossings are handled per step, after
+    which the step is finished without locating further ones."""
+    triggered = []
+    end = t + dt
+    while t < end:
+        y_new = integrator.step(system, t, y, end - t, dydt)
+        if len(triggered) >= max_events:
+            return y_new, triggered
+
+        state_at = lambda t_event: integrator.step(system, t, y, t_event - t, dydt)
+        crossings = []
+        for event in events:
+            g = _start_value(event, event.function(t, y), state_at, t, end)
+            if event.crossed(g, event.function(end, y_new)):
+                tolerance = 1e-9 * max(1.0, abs(end))
+                crossings.append(locate_crossing(event, state_at, t, end, g, tolerance) + (event,))
+
+        if not crossings:
+            return y_new, triggered
+
+        t, y, event = min(crossings, key=lambda crossing: crossing[0])
+        y = event.apply(t, y)
+        dydt = None
+        triggered.append((event, t))
+        if event.terminal:
+            return y, triggered
+
+    return y, triggered
+
+
+class DenseOutput:
+    """Continuous fourth order interpolant of one Dormand-Prince step."""
+
+    def __init__(self, t_old, h, y_old, K, P):
+        self.t_old = t_old
+        self.h = h
+        self.y_old = y_old
+        # Q[j] is the coefficient of theta ** (j + 1)
+        self.Q = np.tensordot(P.T, K, axes=1)
+
+    def __call__(self, t):
+        theta = (t - self.t_old) / self.h
+        powers = theta ** np.arange(1, len(self.Q) + 1)
+        return self.y_old + self.h * np.tensordot(powers, self.Q, axes=1)
+
+
+class Solution:
+    """Result of an adaptive integration. y has shape (len(t),) + y0.shape,
+    and events is a list of (event, t) pairs in the order they triggered."""
+
+    def __init__(self, t, y, n_steps, n_rejected, n_evaluations, events=()):
+        self.t = t
+        self.y = y
+        self.n_steps = n_steps
+        self.n_rejected = n_rejected
+        self.n_evaluations = n_evaluations
+        self.events = list(events)
+
+
+class DormandPrince(Integrator):
+    """Adaptive Dormand-Prince RK5(4) with error control and dense output.
+
+    The step size is chosen so the estimated local error stays within
+    atol + rtol * |y| (RMS norm over all entries, including batch entries), and
+    rejected steps are retried with a smaller step. Steps never go below
+    min_step, where they are accepted regardless of the error, or above
+    max_step. With t_eval the solution is sampled on that grid from the
+    dense output instead of returned at the internal step points.
+
+    step() covers a fixed dt with as many internal steps as the error control
+    needs, so DormandPrince can also stand in for the fixed step schemes
+    (for example as Car.integrator). The step size carries over from one
+    call to the next in next_step.
+
+    Events are located on the dense output of each accepted step, and the
+    integration restarts from the event state after its action. More than
+    max_events events in a row, each within min_step of the one before, mean
+    the events chatter (a Zeno sequence such as a ball bouncing to rest) and
+    make solve raise a RuntimeError instead of stalling the integration."""
+
+    C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+    A = [
+        np.array([]),
+        np.array([1/5]),
+        np.array([3/40, 9/40]),
+        np.array([44/45, -56/15, 32/9]),
+        np.array([19372/6561, -25360/2187, 64448/6561, -212/729]),
+        np.array([9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]),
+    ]
+    B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+    E = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+    P = np.array([
+        [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+        [0, 0, 0, 0],
+        [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+        [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+        [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+        [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+        [0, 40617522/29380423, -110615467/29380423, 69997945/29380423],
+    ])
+
+    def __init__(self, rtol=1e-3, atol=1e-6, min_step=1e-6, max_step=np.inf, first_step=None):
+        self.rtol = rtol
+        self.atol = atol
+        self.min_step = min_step
+        self.max_step = max_step
+        self.first_step = first_step
+        self.n_steps = 0
+        self.n_rejected = 0
+        self.n_evaluations = 0
+        self.next_step = None
+
+    def _error_norm(self, error, y, y_new):
+        scale = self.atol + self.rtol * np.maximum(np.abs(y), np.abs(y_new))
+        return np.sqrt(np.mean((error / scale) ** 2))
+
+    def _initial_step(self, y, dydt, span):
+        if self.first_step is not None:
+            return self.first_step
+        scale = self.atol + self.rtol * np.abs(y)
+        d0 = np.sqrt(np.mean((y / scale) ** 2))
+        d1 = np.sqrt(np.mean((dydt / scale) ** 2))
+        h = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+        return np.clip(h, self.min_step, min(self.max_step, span))
+
+    def attempt(self, system, t, y, h, dydt):
+        """Takes one trial step. Returns (y_new, dydt_new, K, error)."""
+        K = np.empty((7,) + y.shape)
+        K[0] = dydt
+        for s in range(1, 6):
+            dy = np.tensordot(self.A[s], K[:s], axes=1)
+            K[s] = system.derivative(t + self.C[s] * h, y + h * dy)
+        y_new = y + h * np.tensordot(self.B, K[:6], axes=1)
+        K[6] = system.derivative(t + h, y_new)
+        error = h * np.tensordot(self.E, K, axes=1)
+        return y_new, K[6], K, error
+
+    def steps(self, system, t0, y0, t_end, h=None, dydt=None):
+        """Generates the accepted steps as (t, y, dydt, dense_output) tuples.
+
+        The statistics of the run are accumulated in n_steps, n_rejected and
+        n_evaluations, and the next step size is kept in next_step."""
+        t = t0
+        y = np.array(y0, dtype=float)
+        if dydt is None:
+            dydt = system.derivative(t, y)
+            self.n_evaluations += 1
+        if h is None:
+            h = self._initial_step(y, dydt, t_end - t0)
+
+        while t < t_end:
+            proposed = h
+            h = min(h, t_end - t)
+            rejected = False
+            while True:
+                y_new, dydt_new, K, error = self.attempt(system, t, y, h, dydt)
+                self.n_evaluations += 6
+                error_norm = self._error_norm(error, y, y_new)
+                if error_norm <= 1 or h <= self.min_step:
+                    break
+                self.n_rejected += 1
+                rejected = True
+                h = max(self.min_step, h * max(0.2, 0.9 * error_norm ** -0.2))
+
+            dense_output = DenseOutput(t, h, y, K, self.P)
+            t, y, dydt = t + h, y_new, dydt_new
+            self.n_steps += 1
+            yield t, y, dydt, dense_output
+
+            factor = 10 if error_norm == 0 else min(10, max(0.2, 0.9 * error_norm ** -0.2))
+            if rejected or h == proposed:
+                h = h * factor
+            else:
+                # Only shortened to end on t_end, which says nothing
+                # against the proposed size
+                h = max(h * factor, proposed)
+            h = np.clip(h, self.min_step, self.max_step)
+            self.next_step = h
+
+    def step(self, system, t, y, dt, dydt=None):
+        y_new = y
+        for _, y_new, _, _ in self.steps(system, t, y, t + dt, self.next_step, dydt):
+            pass
+        return y_new
+
+    def solve(self, system, t_span, y0, t_eval=None, events=(), max_events=16):
+        t0, t_end = t_span
+        self.n_steps = 0
+        self.n_rejected = 0
+        self.n_evaluations = 0
+        self.next_step = None
+        triggered = []
+        times = [t0]
+        states = [np.array(y0, dtype=float)]
+        if t_eval is not None:
+            t_eval = np.asarray(t_eval, dtype=float)
+            times = []
+            states = []
+            while len(times) < len(t_eval) and t_eval[len(times)] <= t0:
+                times.append(t_eval[len(times)])
+                states.append(np.array(y0, dtype=float))
+
+        t_start, y_start = t0, np.array(y0, dtype=float)
+        # Events in a row, each within min_step of the one before
+        chattering = 0
+        while True:
+            restart = None
+            t_old, y_old = t_start, y_start
+            for t, y, _, dense_output in self.steps(system, t_start, y_start, t_end, self.next_step):
+                crossings = []
+                for event in events:
+                    g_old = _start_value(event, event.function(t_old, y_old), dense_output, t_old, t)
+                    if event.crossed(g_old, event.function(t, y)):
+                        tolerance = 1e-9 * max(1.0, abs(t))
+                        crossings.append(
+                            locate_crossing(event, dense_output, t_old, t, g_old, tolerance) + (event,)
+                        )
+                if crossings:
+                    t, y, event = min(crossings, key=lambda crossing: crossing[0])
+                    if triggered and t - triggered[-1][1] <= self.min_step:
+                        chattering += 1
+                    else:
+                        chattering = 1
+                    if chattering > max_events:
+                        raise RuntimeError(
+                            f"More than {max_events} events within {self.min_step} s of each other "
+                            f"at t = {t}, the events chatter (Zeno behaviour)"
+                        )
+                    triggered.append((event, t))
+                    restart = event
+
+                if t_eval is None:
+                    times.append(t)
+                    states.append(y)
+                else:
+                    while len(times) < len(t_eval) and t_eval[len(times)] <= t:
+                        times.append(t_eval[len(times)])
+                        states.append(dense_output(times[-1]))
+
+                if restart is not None:
+                    break
+                t_old, y_old = t, y
+
+            if restart is None or restart.terminal:
+                break
+            t_start, y_start = t, restart.apply(t, y)
+
+        return Solution(
+            np.array(times), np.array(states), self.n_steps, self.n_rejected, self.n_evaluations, triggered
+        )
+
@@ -0,0 +1,57 @@
+import numpy as np
+
+
+class RegularGrid:
+    """Evenly spaced axes of a lookup table, with the index arithmetic for
+    vectorized multilinear interpolation on them.
+
+    Lookups are a multiply and a gather instead of a search: every point is
+    turned into the flat index of its grid cell, the 2**d cell corners are
+    gathered from the raveled table and reduced with one linear
+    interpolation per axis. Points outside the grid are clamped to its edges.
+    name is used in the error raised for invalid axes.
+    """
+
+    def __init__(self, axes, name="Lookup table") -> None:
+        self.axes = [np.asarray(axis, dtype=float) for axis in axes]
+        for axis in self.axes:
+            if len(axis) < 2 or not np.allclose(np.diff(axis), axis[1] - axis[0]):
+                raise ValueError(f"{name} axes must be evenly spaced with at least two points")
+        self.shape = tuple(len(axis) for axis in self.axes)
+        self._start = np.array([axis[0] for axis in self.axes])
+        self._spacing = np.array([axis[1] - axis[0] for axis in self.axes])
+        self._size = np.array(self.shape)
+
+        # Flat index offsets of the cell corners, first axis slowest
+        self._strides = np.array([int(np.prod(self.shape[k + 1:])) for k in range(len(self.shape))])
+        corners = np.array(np.meshgrid(*[[0, 1]] * len(self.shape), indexing="ij"))
+        self._corner_offsets = corners.reshape(len(self.shape), -1).T @ self._strides
+
+
+    def __len__(self):
+        return len(self.axes)
+
+
+    def interpolate(self, table, *values):
+        """Interpolates table at points given by one coordinate array per
+        axis (broadcast together). table has shape grid.shape, optionally
+        followed by trailing value dimensions that are interpolated together
+        from the same gathers, giving shape points.shape + trailing."""
+        index = 0
+        fractions = []
+        for value, start, spacing, size, stride in zip(
+                np.broadcast_arrays(*values), self._start, self._spacing, self._size, self._strides):
+            position = np.clip((value - start) / spacing, 0, size - 1)
+            lower = np.minimum(position.astype(int), size - 2)
+            index = index + lower * stride
+            fractions.append(position - lower)
+
+        trailing = np.shape(table)[len(self.shape):]
+        flat = np.reshape(table, (-1,) + trailing)
+        corners = [flat.take(index + offset, axis=0) for offset in self._corner_offsets]
+        # Neighbouring corners differ along the last axis, so every pass
+        # halves the corners by interpolating along one axis, last first
+        for fraction in reversed(fractions):
+            fraction = np.reshape(fraction, np.shape(fraction) + (1,) * len(trailing))
+            corners = [low + fraction * (high - low) for low, high in zip(corners[0::2], corners[1::2])]
+        return corners[0]
@@ -1,24 +1,31 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from car import Car
+from powertrain import Transmission
+from telemetry import Telemetry
 
 
 def main():
     car = Car()
     car.throttle = 1
     car.brake = 0
+    car.transmission = Transmission(car.powertrain)
+    # Stop exactly where the speed crosses zero inside a step
+    car.events = [car.stop_event()]
 
     dt = 0.1
     t = np.arange(0, 100, dt)
-    pos = np.zeros((len(t), 2))
-    yaw = np.zeros(len(t))
-    vel = np.zeros((len(t), 2))
-    gear = np.zeros(len(t))
-    rpm = np.zeros(len(t))
-    motor_force = np.zeros(len(t))
-
-    max_rpm = car.max_rpm
-
+    telemetry = Telemetry(
+        [
+            ("pos", float, (2,)),
+            ("yaw", float),
+            ("vel", float, (2,)),
+            ("gear", int),
+            ("rpm", float),
+            ("motor_force", float),
+        ],
+        capacity=len(t),
+    )
 
     for i in range(len(t)):
 
@@ -26,19 +33,21 @@ def main():
             car.throttle = 0
             car.brake = 1
 
-        pos[i] = car.pos
-        yaw[i] = car.yaw
-        vel[i] = car.vel
-        gear[i] = car.gear
-        rpm[i] = car.motor_rpm
-        motor_force[i] = car.motor_force
+        telemetry.record(
+            pos=car.pos,
+            yaw=car.yaw,
+            vel=car.vel,
+            gear=car.gear,
+            rpm=car.motor_rpm,
+            motor_force=car.motor_force,
+        )
         car.update(dt)
-        if car.motor_rpm > 0.9 * max_rpm:
-            car.gear += 1
-    
-    speed = np.linalg.norm(vel, axis=1) * 3.6
 
-    power = motor_force * speed / 3.6 / 1000 * 1.34 # hp
+    gear = telemetry["gear"]
+    rpm = telemetry["rpm"]
+    speed = np.linalg.norm(telemetry["vel"], axis=1) * 3.6
+
+    power = telemetry["motor_force"] * speed / 3.6 / 1000 * 1.34 # hp
 
     # Plot graphs on top of each other
     plt.figure()
@@ -1,8 +1,15 @@
 
 
+import hashlib
+import importlib.util
+import os
+from functools import partial
 import numpy as np
-from scipy.linalg import solve, lstsq, null_space
-from scipy.sparse.linalg import spsolve
+from collections import OrderedDict
+from scipy.linalg import solve, solve_triangular, lstsq, null_space, lu_factor, lu_solve
+from scipy.sparse import csc_matrix, csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
+from scipy.sparse.linalg import spsolve, splu
 from time import perf_counter as timer
 
 
@@ -30,6 +37,357 @@ def print_null_space(A, variable_names):
 
 
 
+def strongly_connected_components(adjacency):
+    """Tarjan's algorithm on a list of successor lists.
+
+    The components are returned in reverse topological order, so every
+    component comes after all the components it has edges to. Iterative, so
+    large systems do not hit the recursion limit."""
+    index_of = [-1] * len(adjacency)
+    lowlink = [0] * len(adjacency)
+    on_stack = [False] * len(adjacency)
+    stack = []
+    components = []
+    counter = 0
+
+    for root in range(len(adjacency)):
+        if index_of[root] != -1:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, edge = work.pop()
+            if edge == 0:
+                index_of[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack[node] = True
+            recurse = False
+            for k in range(edge, len(adjacency[node])):
+                successor = adjacency[node][k]
+                if index_of[successor] == -1:
+                    work.append((node, k + 1))
+                    work.append((successor, 0))
+                    recurse = True
+                    break
+                if on_stack[successor]:
+                    lowlink[node] = min(lowlink[node], index_of[successor])
+            if recurse:
+                continue
+            if lowlink[node] == index_of[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+    return components
+
+
+class Expression:
+    """Symbolic coefficient expression.
+
+    Expressions are built from Symbol("name") with ordinary arithmetic and can
+    be used anywhere a coefficient callable is accepted, since calling one
+    with a state evaluates it. Unlike an opaque lambda they can also be
+    compiled into a generated kernel by CompiledLinearSystem.compile_kernel.
+    """
+
+    # Make NumPy scalars defer to our operators instead of broadcasting
+    __array_ufunc__ = None
+
+    def __add__(self, other):
+        return Operation("+", self, other)
+
+    def __radd__(self, other):
+        return Operation("+", other, self)
+
+    def __sub__(self, other):
+        return Operation("-", self, other)
+
+    def __rsub__(self, other):
+        return Operation("-", other, self)
+
+    def __mul__(self, other):
+        return Operation("*", self, other)
+
+    def __rmul__(self, other):
+        return Operation("*", other, self)
+
+    def __truediv__(self, other):
+        return Operation("/", self, other)
+
+    def __rtruediv__(self, other):
+        return Operation("/", other, self)
+
+    def __pow__(self, other):
+        return Operation("**", self, other)
+
+    def __rpow__(self, other):
+        return Operation("**", other, self)
+
+    def __neg__(self):
+        return Negation(self)
+
+
+class Symbol(Expression):
+    """A named quantity read from the state."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __call__(self, state):
+        return state[self.name]
+
+    def key(self):
+        return f"s:{self.name}"
+
+    def __repr__(self):
+        return f"Symbol({self.name!r})"
+
+
+class Operation(Expression):
+    """A binary arithmetic operation on expressions or numbers."""
+
+    _operators = {
+        "+": lambda a, b: a + b,
+        "-": lambda a, b: a - b,
+        "*": lambda a, b: a * b,
+        "/": lambda a, b: a / b,
+        "**": lambda a, b: a ** b,
+    }
+
+    def __init__(self, operator: str, left, right) -> None:
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def __call__(self, state):
+        left = self.left(state) if isinstance(self.left, Expression) else self.left
+        right = self.right(state) if isinstance(self.right, Expression) else self.right
+        return self._operators[self.operator](left, right)
+
+    def key(self):
+        return f"({self.operator} {expression_key(self.left)} {expression_key(self.right)})"
+
+    def __repr__(self):
+        return f"({self.left!r} {self.operator} {self.right!r})"
+
+
+class Negation(Expression):
+
+    def __init__(self, operand) -> None:
+        self.operand = operand
+
+    def __call__(self, state):
+        return -self.operand(state)
+
+    def key(self):
+        return f"(neg {self.operand.key()})"
+
+    def __repr__(self):
+        return f"-{self.operand!r}"
+
+
+def expression_key(expression):
+    """Canonical string of an expression or number, used for common
+    subexpression elimination and for hashing systems."""
+    if isinstance(expression, Expression):
+        return expression.key()
+    return repr(float(expression))
+
+
+class KernelGenerator:
+    """Generates the source of a coefficient kernel.
+
+    Each distinct subexpression is emitted once as a local variable, so terms
+    shared between coefficients (for example body.yaw.vel ** 2) are only
+    evaluated once per call. Callables that are not Expressions are called
+    through the functions argument."""
+
+    def __init__(self, layout) -> None:
+        self.layout = layout
+        self.lines = []
+        self.names = {}
+        self.functions = []
+
+    def emit(self, expression):
+        if not isinstance(expression, Expression):
+            if callable(expression):
+                self.functions.append(expression)
+                return f"functions[{len(self.functions) - 1}](state)"
+            return repr(float(expression))
+
+        key = expression.key()
+        if key in self.names:
+            return self.names[key]
+
+        if isinstance(expression, Symbol):
+            if expression.name not in self.layout:
+                raise KeyError(f"Symbol {expression.name!r} is not in the state layout")
+            code = f"x[..., {self.layout.index[expression.name]}]"
+            name = f"s{len(self.names)}"
+        elif isinstance(expression, Negation):
+            code = f"-({self.emit(expression.operand)})"
+            name = f"t{len(self.names)}"
+        else:
+            left = self.emit(expression.left)
+            right = self.emit(expression.right)
+            # A negative literal operand would otherwise bind wrongly (-2.0 ** a)
+            code = f"({left}) {expression.operator} ({right})"
+            name = f"t{len(self.names)}"
+
+        self.lines.append(f"    {name} = {code}")
+        self.names[key] = name
+        return name
+
+    def generate(self, A_functions, b_functions):
+        assignments = []
+        for k, function in enumerate(A_functions):
+            assignments.append(f"    A_values[..., {k}] = {self.emit(function)}")
+        for k, function in enumerate(b_functions):
+            assignments.append(f"    b_values[..., {k}] = {self.emit(function)}")
+        return "\n".join(
+            ["def evaluate(x, state, A_values, b_values, functions=()):"]
+            + self.lines
+            + assignments
+            + ["    return A_values, b_values", ""]
+        )
+
+
+KERNEL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "physics_kernels")
+
+
+def load_coefficient_kernel(layout, A_functions, b_functions, cache_dir=None):
+    """Returns a generated function evaluate(x, state, A_values, b_values)
+    that writes every dynamic coefficient from the flat state array x.
+
+    The generated module is stored in cache_dir under a hash of the layout and
+    the coefficient expressions, so later runs import it instead of
+    generating it again."""
+    if cache_dir is None:
+        cache_dir = KERNEL_CACHE_DIR
+
+    functions = [f for f in A_functions + b_functions if not isinstance(f, Expression)]
+    description = "\n".join(
+        ["kernel v2"]
+        + layout.names
+        + ["A " + (expression_key(f) if isinstance(f, Expression) else "<callable>") for f in A_functions]
+        + ["b " + (expression_key(f) if isinstance(f, Expression) else "<callable>") for f in b_functions]
+    )
+    digest = hashlib.sha256(description.encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"coefficients_{digest}.py")
+
+    if not os.path.exists(path):
+        source = KernelGenerator(layout).generate(A_functions, b_functions)
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(source)
+        os.replace(temporary_path, path)
+
+    spec = importlib.util.spec_from_file_location(f"coefficients_{digest}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return partial(module.evaluate, functions=tuple(functions))
+
+
+class StateLayout:
+    """Assigns every named quantity of a simulation a fixed slot in one float64
+    array.
+
+    The hot loop works on the array directly with precomputed index arrays,
+    while view() gives the named access that the coefficient functions and
+    the rest of the convenience API use. A batch of states is a 2-D array
+    with one row per environment, and its view returns whole columns.
+    """
+
+    def __init__(self, names: list) -> None:
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        if len(self.index) != len(self.names):
+            raise ValueError("State names must be unique")
+
+
+    @classmethod
+    def from_dicts(cls, *dicts):
+        """Creates a layout with the keys of the given dicts, in order."""
+        names = []
+        for values in dicts:
+            names += [name for name in values if name not in names]
+        return cls(names)
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def __contains__(self, name):
+        return name in self.index
+
+
+    def indices(self, names):
+        """Returns the slots of the given names as an index array."""
+        return np.array([self.index[name] for name in names], dtype=int)
+
+
+    def new_state(self, values: dict = None, batch_size: int = None):
+        """Returns a zeroed state array, optionally filled from a dict. With
+        batch_size the array has shape (batch_size, len(layout))."""
+        if batch_size is None:
+            state = np.zeros(len(self.names))
+        else:
+            state = np.zeros((batch_size, len(self.names)))
+        if values is not None:
+            for name in values:
+                state[..., self.index[name]] = values[name]
+        return state
+
+
+    def view(self, state):
+        return StateView(self, state)
+
+
+class StateView:
+    """Named access to a state array. Reads and writes go straight to the
+    underlying array, nothing is copied. Names index the last axis, so for a
+    batch (or a stack of batches) of states each name maps to all the
+    leading axes."""
+
+    __slots__ = ("layout", "array")
+
+    def __init__(self, layout: StateLayout, array) -> None:
+        self.layout = layout
+        self.array = array
+
+
+    def __getitem__(self, name):
+        return self.array[..., self.layout.index[name]]
+
+
+    def __setitem__(self, name, value):
+        self.array[..., self.layout.index[name]] = value
+
+
+    def __contains__(self, name):
+        return name in self.layout.index
+
+
+    def keys(self):
+        return self.layout.names
+
+
+    def to_dict(self):
+        return dict(zip(self.layout.names, np.moveaxis(self.array, -1, 0)))
+
+
+
+
 class PhysicsComponent:
 
     def __init__(self, name: str, equations: dict) -> None:
@@ -238,6 +596,30 @@ class PhysicsSystem:
                     numeric_b.append(constant)
 
             return np.array(numeric_A), np.array(numeric_b)
+
+
+        def compile_linear_system(
+                self,
+                A,
+                b,
+                variable_names,
+                sparse=False,
+                factorization_cache_size=16,
+            ):
+            """Compiles the symbolic system from create_linear_system into a
+            CompiledLinearSystem that only re-evaluates the callable entries.
+
+            With sparse=True the system is solved with a sparse LU
+            factorization whose column ordering is computed only once.
+            Factorizations are cached on the values of the dynamic entries of A,
+            keeping at most factorization_cache_size of them."""
+            return CompiledLinearSystem(
+                A,
+                b,
+                variable_names,
+                sparse=sparse,
+                factorization_cache_size=factorization_cache_size,
+            )
             
         
         
@@ -248,3 +630,592 @@ class PhysicsSystem:
         #     # Validate the solution
                         
 
+
+
+class CompiledLinearSystem:
+    """Preallocated numeric form of a symbolic linear system.
+
+    The constant coefficients are written into a NumPy matrix once, and the
+    callable coefficients are kept in a compact (row, col, function) table.
+    Each evaluation only calls those functions and writes their results back
+    into the preallocated arrays.
+
+    With sparse=True, A is also kept in CSC form. The sparsity pattern (the
+    constant nonzeros plus every dynamic slot) never changes, so the fill
+    reducing column ordering is computed on the first factorization and every
+    later step only refills the CSC data and does a numeric factorization.
+
+    Only the callables in A_functions feed the coefficient matrix, and in
+    practice they depend on discrete inputs such as the gear ratio. The LU
+    factorizations are therefore cached in an LRU cache keyed on the values of
+    those entries, so most steps only do the triangular solves. cache_hits and
+    cache_misses count how often the cache was used.
+    """
+
+    def __init__(self, A, b, variable_names, sparse=False, factorization_cache_size=16):
+        self.variable_names = list(variable_names)
+        self.A = np.zeros((len(A), len(variable_names)))
+        self.b = np.zeros(len(b))
+
+        A_rows, A_cols, A_functions = [], [], []
+        for i, eqn in enumerate(A):
+            for j, constant in enumerate(eqn):
+                if callable(constant):
+                    A_rows.append(i)
+                    A_cols.append(j)
+                    A_functions.append(constant)
+                else:
+                    self.A[i, j] = constant
+
+        b_rows, b_functions = [], []
+        for i, constant in enumerate(b):
+            if callable(constant):
+                b_rows.append(i)
+                b_functions.append(constant)
+            else:
+                self.b[i] = constant
+
+        self.A_rows = np.array(A_rows, dtype=int)
+        self.A_cols = np.array(A_cols, dtype=int)
+        self.A_functions = A_functions
+        self.b_rows = np.array(b_rows, dtype=int)
+        self.b_functions = b_functions
+
+        self._A_values = np.zeros(len(A_functions))
+        self._b_values = np.zeros(len(b_functions))
+        self._batch_A = None
+        self._batch_b = None
+        self._batch_A_values = None
+        self._batch_b_values = None
+        self.kernel = None
+
+        self.factorization_cache_size = factorization_cache_size
+        self._factorization_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.sparse = sparse
+        if sparse:
+            self._pattern_rows, self._pattern_cols = np.nonzero(self.structure())
+            self._column_permutation = None
+            self._build_csc(np.arange(self.A.shape[1]))
+
+
+    def _build_csc(self, column_permutation):
+        """Builds the CSC structure of A with column j moved to position
+        column_permutation[j], and the data slots of every pattern entry."""
+        n_entries = len(self._pattern_rows)
+        index_matrix = csc_matrix(
+            (
+                np.arange(1, n_entries + 1),
+                (self._pattern_rows, column_permutation[self._pattern_cols])
+            ),
+            shape=self.A.shape,
+        )
+        entry_of_slot = index_matrix.data - 1
+        slot_of_entry = np.empty(n_entries, dtype=int)
+        slot_of_entry[entry_of_slot] = np.arange(n_entries)
+
+        slot_lookup = {
+            (i, j): slot for i, j, slot
+            in zip(self._pattern_rows, self._pattern_cols, slot_of_entry)
+        }
+        self._A_slots = np.array(
+            [slot_lookup[(i, j)] for i, j in zip(self.A_rows, self.A_cols)], dtype=int
+        )
+
+        self.A_csc = csc_matrix(
+            (
+                self.A[self._pattern_rows, self._pattern_cols][entry_of_slot],
+                index_matrix.indices,
+                index_matrix.indptr,
+            ),
+            shape=self.A.shape,
+        )
+
+
+    def variable_index(self, names):
+        """Returns the indices of the given variable names in the solution vector."""
+        return np.array([self.variable_names.index(name) for name in names], dtype=int)
+
+
+    def compile_kernel(self, layout, cache_dir=None):
+        """Replaces the per-coefficient calls with one generated function.
+
+        States passed to this system afterwards must be views of layout."""
+        self.kernel = load_coefficient_kernel(layout, self.A_functions, self.b_functions, cache_dir)
+
+
+    def evaluate(self, state):
+        """Evaluates every dynamic entry of A and b and returns their values."""
+        if self.kernel is not None:
+            self.kernel(state.array, state, self._A_values, self._b_values)
+            return self._A_values, self._b_values
+        for k, function in enumerate(self.A_functions):
+            self._A_values[k] = function(state)
+        for k, function in enumerate(self.b_functions):
+            self._b_values[k] = function(state)
+        return self._A_values, self._b_values
+
+
+    def evaluate_A(self, state):
+        if self.kernel is not None:
+            return self.evaluate(state)[0]
+        for k, function in enumerate(self.A_functions):
+            self._A_values[k] = function(state)
+        return self._A_values
+
+
+    def evaluate_b(self, state):
+        if self.kernel is not None:
+            return self.evaluate(state)[1]
+        for k, function in enumerate(self.b_functions):
+            self._b_values[k] = function(state)
+        return self._b_values
+
+
+    def numeric_linear_system(self, state):
+        """Refills the dynamic entries in place and returns the numeric A and b.
+
+        The returned arrays are owned by the compiled system and are overwritten
+        by the next call."""
+        A_values, b_values = self.evaluate(state)
+        self.A[self.A_rows, self.A_cols] = A_values
+        self.b[self.b_rows] = b_values
+        return self.A, self.b
+
+
+    def structure(self):
+        """Returns the boolean structural pattern of A: constant nonzeros plus
+        every dynamic slot."""
+        pattern = self.A != 0
+        pattern[self.A_rows, self.A_cols] = True
+        return pattern
+
+
+    def block_triangular(self):
+        """Returns a BlockTriangularSystem that solves this system in stages."""
+        return BlockTriangularSystem(self)
+
+
+    def condense(self, output_names, reference_state):
+        """Returns a CondensedLinearSystem that only solves for output_names."""
+        return CondensedLinearSystem(self, output_names, reference_state)
+
+
+    def factorize(self, state):
+        """Returns the LU factorization of A for the given state, reusing a
+        cached one if the dynamic entries of A have been seen before."""
+        return self._factorize(self.evaluate_A(state))
+
+
+    def _factorize(self, A_values):
+        key = A_values.tobytes()
+
+        factorization = self._factorization_cache.get(key)
+        if factorization is not None:
+            self._factorization_cache.move_to_end(key)
+            self.cache_hits += 1
+            return factorization
+
+        self.cache_misses += 1
+        if self.sparse:
+            factorization = self._sparse_factorize(A_values)
+        else:
+            self.A[self.A_rows, self.A_cols] = A_values
+            factorization = lu_factor(self.A)
+
+        if self.factorization_cache_size > 0:
+            self._factorization_cache[key] = factorization
+            if len(self._factorization_cache) > self.factorization_cache_size:
+                self._factorization_cache.popitem(last=False)
+        return factorization
+
+
+    def clear_factorization_cache(self):
+        self._factorization_cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+    def evaluate_batch(self, states):
+        """Evaluates the dynamic entries of A and b for a batch of states and
+        returns them as (N, k) arrays.
+
+        The coefficient functions are called once with the whole batch, so
+        they have to be written with NumPy operations (as the ones reading
+        state["name"] and doing arithmetic already are)."""
+        n_envs = len(states.array)
+        if self._batch_A_values is None or len(self._batch_A_values) != n_envs:
+            self._batch_A_values = np.zeros((n_envs, len(self.A_functions)))
+            self._batch_b_values = np.zeros((n_envs, len(self.b_functions)))
+
+        if self.kernel is not None:
+            self.kernel(states.array, states, self._batch_A_values, self._batch_b_values)
+        else:
+            for k, function in enumerate(self.A_functions):
+                self._batch_A_values[:, k] = function(states)
+            for k, function in enumerate(self.b_functions):
+                self._batch_b_values[:, k] = function(states)
+        return self._batch_A_values, self._batch_b_values
+
+
+    def numeric_linear_system_batch(self, states):
+        """Assembles the stacked (N, n, n) coefficients and (N, n) right hand
+        sides for a batch of states. The returned arrays are owned by the
+        compiled system and reused between calls."""
+        n_envs = len(states.array)
+        if self._batch_A is None or len(self._batch_A) != n_envs:
+            self._batch_A = np.repeat(self.A[None], n_envs, axis=0)
+            self._batch_b = np.repeat(self.b[None], n_envs, axis=0)
+
+        self.evaluate_batch(states)
+        self._batch_A[:, self.A_rows, self.A_cols] = self._batch_A_values
+        self._batch_b[:, self.b_rows] = self._batch_b_values
+        return self._batch_A, self._batch_b
+
+
+    def solve_batch(self, states):
+        """Solves the system for every state of a batch in one batched LAPACK
+        call. Returns an (N, n) array of solutions."""
+        A, b = self.numeric_linear_system_batch(states)
+        return np.linalg.solve(A, b[..., None])[..., 0]
+
+
+    def solve(self, state):
+        A_values, b_values = self.evaluate(state)
+        factorization = self._factorize(A_values)
+        self.b[self.b_rows] = b_values
+        if self.sparse:
+            return factorization.solve(self.b)[self._column_permutation]
+        return lu_solve(factorization, self.b)
+
+
+    def _sparse_factorize(self, A_values):
+        if self._column_permutation is None:
+            # First factorization: let SuperLU pick the ordering, then bake it
+            # into the CSC structure so later steps can skip the analysis.
+            self.A_csc.data[self._A_slots] = A_values
+            self._column_permutation = splu(self.A_csc, permc_spec="COLAMD").perm_c
+            self._build_csc(self._column_permutation)
+
+        self.A_csc.data[self._A_slots] = A_values
+        return splu(self.A_csc, permc_spec="NATURAL")
+
+
+
+class CondensedLinearSystem:
+    """Static condensation of a CompiledLinearSystem onto a few outputs.
+
+    Most unknowns of a PhysicsSystem are internal forces and accelerations
+    that the integrator never reads. The coefficient matrix is split into a
+    constant part A0, taken at reference_state, and the k dynamic entries,
+    which enter as a rank-k correction. A0 is eliminated once, leaving
+    per-step work of a few small matrix-vector products and a k-by-k solve
+    (Woodbury / Schur complement on the dynamic entries):
+
+        (I + M diag(delta)) y = g_c,   x_out = g_out - N (delta * y)
+
+    where delta is the change of the dynamic entries from the reference.
+    The full solution can still be recovered for telemetry with recover().
+    """
+
+    def __init__(self, system: CompiledLinearSystem, output_names, reference_state):
+        self.system = system
+        self.output_names = list(output_names)
+        self.output_index = system.variable_index(output_names)
+
+        self._reference_A_values = system.evaluate_A(reference_state).copy()
+        A0 = system.A.copy()
+        A0[system.A_rows, system.A_cols] = self._reference_A_values
+        self._lu = lu_factor(A0)
+        inverse = lu_solve(self._lu, np.eye(A0.shape[0]))
+
+        self._b_constant = system.b.copy()
+        self._b_constant[system.b_rows] = 0
+
+        output_inverse = inverse[self.output_index]
+        self._output_constant = output_inverse @ self._b_constant
+        self._output_b = output_inverse[:, system.b_rows]
+        self._output_A = output_inverse[:, system.A_rows]
+
+        coupling_inverse = inverse[system.A_cols]
+        self._coupling_constant = coupling_inverse @ self._b_constant
+        self._coupling_b = coupling_inverse[:, system.b_rows]
+        self._coupling_A = coupling_inverse[:, system.A_rows]
+        self._identity = np.eye(len(system.A_functions))
+
+
+    def _coupling_correction(self, delta, b_values):
+        """Returns delta * y, the rank-k correction for the dynamic entries."""
+        if not np.any(delta):
+            return None
+        g_c = self._coupling_constant + self._coupling_b @ b_values
+        y = np.linalg.solve(self._identity + self._coupling_A * delta, g_c)
+        return delta * y
+
+
+    def solve(self, state):
+        """Returns the values of the output variables, in output_names order."""
+        A_values, b_values = self.system.evaluate(state)
+        delta = A_values - self._reference_A_values
+
+        x_out = self._output_constant + self._output_b @ b_values
+        correction = self._coupling_correction(delta, b_values)
+        if correction is not None:
+            x_out -= self._output_A @ correction
+        return x_out
+
+
+    def solve_batch(self, states):
+        """Returns an (N, len(output_names)) array of outputs for a batch of
+        states."""
+        A_values, b_values = self.system.evaluate_batch(states)
+        delta = A_values - self._reference_A_values
+
+        x_out = self._output_constant + b_values @ self._output_b.T
+        if np.any(delta):
+            g_c = self._coupling_constant + b_values @ self._coupling_b.T
+            coupling = self._identity + self._coupling_A * delta[:, None, :]
+            y = np.linalg.solve(coupling, g_c[..., None])[..., 0]
+            x_out -= (delta * y) @ self._output_A.T
+        return x_out
+
+
+    def recover(self, state):
+        """Returns the full solution vector, for telemetry and debugging."""
+        A_values, b_values = self.system.evaluate(state)
+        delta = A_values - self._reference_A_values
+
+        rhs = self._b_constant.copy()
+        rhs[self.system.b_rows] += b_values
+        correction = self._coupling_correction(delta, b_values)
+        if correction is not None:
+            np.subtract.at(rhs, self.system.A_rows, correction)
+        return lu_solve(self._lu, rhs)
+
+
+
+class BlockTriangularSystem:
+    """Block lower triangular (Dulmage-Mendelsohn) ordering of a
+    CompiledLinearSystem.
+
+    Every variable is matched to an equation that determines it with a maximum
+    bipartite matching on the structural pattern. The strongly connected
+    components of the resulting dependency graph are the blocks that have to
+    be solved together, ordered so each block only depends on earlier ones.
+    Decoupled subsystems end up in separate small blocks instead of one large
+    coupled solve.
+
+    Structural singularities are reported by variable name when the system is
+    built, before any numeric solve.
+
+    The solve runs in stages whose index arrays are precomputed: every run of
+    consecutive 1x1 blocks is one lower triangular solve, and only the
+    algebraic loops (blocks of several variables) are LU factorized, each
+    factorization reused while the values of its block do not change.
+    """
+
+    def __init__(self, system: CompiledLinearSystem):
+        self.system = system
+        pattern = system.structure()
+        n_rows, n_cols = pattern.shape
+
+        row_of_col = maximum_bipartite_matching(csr_matrix(pattern), perm_type="row")
+        unmatched_cols = np.flatnonzero(row_of_col == -1)
+        matched_rows = np.zeros(n_rows, dtype=bool)
+        matched_rows[row_of_col[row_of_col != -1]] = True
+        unmatched_rows = np.flatnonzero(~matched_rows)
+        if len(unmatched_cols) > 0 or len(unmatched_rows) > 0:
+            raise ValueError(self._singularity_message(pattern, unmatched_cols, unmatched_rows))
+
+        # Variable j is computed from equation row_of_col[j], which depends on
+        # every other variable in that equation.
+        adjacency = []
+        for j in range(n_cols):
+            dependencies = np.flatnonzero(pattern[row_of_col[j]])
+            adjacency.append([int(c) for c in dependencies if c != j])
+
+        self.blocks = []
+        for component in strongly_connected_components(adjacency):
+            cols = np.array(sorted(component), dtype=int)
+            rows = row_of_col[cols]
+            in_block = np.zeros(n_cols, dtype=bool)
+            in_block[cols] = True
+            external = np.flatnonzero(pattern[rows].any(axis=0) & ~in_block)
+            self.blocks.append((rows, cols, external))
+
+        # Consecutive 1x1 blocks are merged into one stage; their diagonal
+        # submatrix is lower triangular in block order.
+        runs = []
+        for rows, cols, _ in self.blocks:
+            loop = len(cols) > 1
+            if runs and not loop and not runs[-1][0]:
+                runs[-1][1].append(rows)
+                runs[-1][2].append(cols)
+            else:
+                runs.append((loop, [rows], [cols]))
+
+        # Each stage is (loop, rows, cols, external, diagonal index,
+        # coupling index), the indices flat positions in A.
+        self._stages = []
+        self._factorizations = {}
+        for loop, rows, cols in runs:
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+            in_stage = np.zeros(n_cols, dtype=bool)
+            in_stage[cols] = True
+            external = np.flatnonzero(pattern[rows].any(axis=0) & ~in_stage)
+            self._stages.append((
+                loop,
+                rows,
+                cols,
+                external,
+                rows[:, None] * n_cols + cols,
+                rows[:, None] * n_cols + external,
+            ))
+
+
+    def _singularity_message(self, pattern, unmatched_cols, unmatched_rows):
+        names = self.system.variable_names
+        lines = ["Structurally singular system."]
+        if len(unmatched_cols) > 0:
+            lines.append(
+                "No equation determines: "
+                + ", ".join(names[j] for j in unmatched_cols)
+            )
+        for i in unmatched_rows:
+            involved = [names[j] for j in np.flatnonzero(pattern[i])]
+            if involved:
+                lines.append(f"Equation {i} is redundant, it only involves: " + ", ".join(involved))
+            else:
+                lines.append(f"Equation {i} has no variables")
+        return "\n".join(lines)
+
+
+    def describe(self):
+        """Returns the blocks as lists of variable names, in solve order."""
+        names = self.system.variable_names
+        return [[names[j] for j in cols] for _, cols, _ in self.blocks]
+
+
+    def solve(self, state):
+        A, b = self.system.numeric_linear_system(state)
+        x = np.zeros(A.shape[1])
+        for index, (loop, rows, cols, external, diagonal, coupling) in enumerate(self._stages):
+            rhs = b.take(rows)
+            if len(external):
+                rhs -= A.take(coupling) @ x.take(external)
+            block = A.take(diagonal)
+            if loop:
+                x[cols] = lu_solve(self._factorize(index, block), rhs, check_finite=False)
+            else:
+                x[cols] = solve_triangular(block, rhs, lower=True, check_finite=False)
+        return x
+
+
+    def _factorize(self, index, block):
+        cached = self._factorizations.get(index)
+        if cached is None or not np.array_equal(cached[0], block):
+            cached = (block, lu_factor(block, check_finite=False))
+            self._factorizations[index] = cached
+        return cached[1]
+
+
+
+class PhysicsDynamics:
+    """Exposes a PhysicsSystem simulation through the derivative interface of
+    integrators.py.
+
+    The integrated state y is the StateLayout array itself (or a batch of
+    them). The derivative of every name in velocity_names is the matching
+    ".acc" variable of the solved system, and every ".pos" name with a
+    matching ".vel" defaults to that velocity. Everything else has a zero
+    derivative and is only carried along.
+
+    compute_state(t, state) is called before each solve to fill in the
+    quantities that depend on the current state (tire forces, motor torque
+    and so on), and kinematics(t, state, derivative) can override position
+    derivatives, for example to rotate body velocities into the world frame.
+
+    Batches of states (2-D arrays) are solved with solve_batch. Set
+    vectorized=True when compute_state and kinematics also handle batches;
+    the integrators then evaluate stacked states, such as finite difference
+    perturbations, in one call.
+    """
+
+    def __init__(
+            self,
+            system,
+            layout: StateLayout,
+            velocity_names: list,
+            compute_state: callable = None,
+            kinematics: callable = None,
+            vectorized: bool = False,
+            ) -> None:
+        self.system = system
+        self.layout = layout
+        self.compute_state = compute_state
+        self.kinematics = kinematics
+        self.vectorized = vectorized
+
+        self.velocity_names = list(velocity_names)
+        self.velocity_index = layout.indices(self.velocity_names)
+        acc_names = [name[:-4] + ".acc" for name in self.velocity_names]
+        if hasattr(system, "output_names"):
+            self.acc_index = np.array([system.output_names.index(name) for name in acc_names], dtype=int)
+        else:
+            self.acc_index = system.variable_index(acc_names)
+
+        position_names = [
+            name for name in layout.names
+            if name.endswith(".pos") and name[:-4] + ".vel" in layout
+        ]
+        self.position_index = layout.indices(position_names)
+        self.position_velocity_index = layout.indices([name[:-4] + ".vel" for name in position_names])
+
+        self.velocity_mask = np.zeros(len(layout), dtype=bool)
+        self.velocity_mask[self.velocity_index] = True
+        # The entries that are actually integrated, used by implicit schemes
+        self.state_index = np.concatenate([self.velocity_index, self.position_index])
+
+
+    def restrict(self, velocity_names, reference_state):
+        """Returns a PhysicsDynamics that only solves for the accelerations of
+        velocity_names, for use as the system of a fast RateGroup. The solve is
+        condensed onto those accelerations at reference_state."""
+        compiled = getattr(self.system, "system", self.system)
+        condensed = compiled.condense([name[:-4] + ".acc" for name in velocity_names], reference_state)
+        return PhysicsDynamics(
+            condensed,
+            self.layout,
+            velocity_names,
+            compute_state=self.compute_state,
+            kinematics=self.kinematics,
+            vectorized=self.vectorized,
+        )
+
+
+    def position_derivative(self, t, y):
+        derivative = np.zeros_like(y)
+        derivative[..., self.position_index] = y[..., self.position_velocity_index]
+        if self.kinematics is not None:
+            self.kinematics(t, self.layout.view(y), self.layout.view(derivative))
+        return derivative
+
+
+    def derivative(self, t, y):
+        if y.ndim > 2:
+            return self.derivative(t, y.reshape(-1, y.shape[-1])).reshape(y.shape)
+
+        state = self.layout.view(y)
+        if self.compute_state is not None:
+            self.compute_state(t, state)
+        if y.ndim == 1:
+            x = self.system.solve(state)
+        else:
+            x = self.system.solve_batch(state)
+
+        derivative = self.position_derivative(t, y)
+        derivative[..., self.velocity_index] = x[..., self.acc_index]
+        return derivative
@@ -1,4 +1,9 @@
 from physics import *
+from integrators import LinearlyImplicitEuler
+from tire_model import exponential_slip_force
+from wheel_kinematics import WheelKinematics
+from powertrain import Powertrain, TorqueMap
+from telemetry import Telemetry
 
 
 
@@ -34,26 +39,13 @@ gear_count = 6
 gear_ratios = np.array([gear_count/n for n in range(1, gear_count+1)])
 
 
-def get_centrifugal_acc(state, wheel_name):
-    return state["body.yaw.vel"] ** 2 * wheel_positions[wheel_name]
+def get_centrifugal_acc(wheel_name):
+    return Symbol("body.yaw.vel") ** 2 * wheel_positions[wheel_name]
 
 def calculate_slip_force(slip_vel):
     normal_force = 9.82 * mass / 4
     mu = 0.8
-    slip_norm = np.linalg.norm(slip_vel)
-    if slip_norm == 0:
-        return np.array([0,0])
-    slip_direction = slip_vel / slip_norm
-    force_magnitude = (1 - np.exp(-slip_norm)) * mu * normal_force
-    return -slip_direction * force_magnitude
-
-def calculate_motor_rpm(input_variables, state_defining):
-    rl_rpm = state_defining["wheel_rl.shaft_in.vel"] / (2*np.pi) * 60
-    rr_rpm = state_defining["wheel_rr.shaft_in.vel"] / (2*np.pi) * 60
-    diff_rpm = (rl_rpm + rr_rpm) / 2
-    gear_ratio = gear_ratios[input_variables["gear"] - 1]
-    return diff_rpm * gear_ratio
-
+    return exponential_slip_force(slip_vel, normal_force, mu)
 
 def motor_torque_curve(throttle, rpm):
     max_rpm = 8000
@@ -61,6 +53,18 @@ def motor_torque_curve(throttle, rpm):
     x = rpm / max_rpm
     return throttle * (1-x)*(x+0.5)**2 * 2 * max_torque
 
+# The curve is tabulated once, the simulation only interpolates the map
+powertrain = Powertrain(
+    TorqueMap.from_function(motor_torque_curve, max_rpm=8000),
+    gear_ratios,
+    wheel_radius,
+)
+
+def calculate_motor_rpm(state):
+    diff_speed = (state["wheel_rl.shaft_in.vel"] + state["wheel_rr.shaft_in.vel"]) / 2
+    gear = np.asarray(state["gear"]).astype(int) - 1
+    return powertrain.rpm_from_wheel_speed(diff_speed, gear)
+
 
 
 
@@ -73,7 +77,7 @@ motor = PhysicsComponent(
     [
         {
             "input.force": 1,
-            "RHS": lambda state: state["motor_torque"],
+            "RHS": Symbol("motor_torque"),
         },
         {
             "input.force": 1,
@@ -88,11 +92,11 @@ gearbox = PhysicsComponent(
     [
         {
             "shaft_out.force": 1,
-            "shaft_in.force": lambda state: state["gear_ratio"],
+            "shaft_in.force": Symbol("gear_ratio"),
         },
         {
             "shaft_in.acc": 1,
-            "shaft_out.acc": lambda state: -state["gear_ratio"],
+            "shaft_out.acc": -Symbol("gear_ratio"),
         }
     ]
 )
@@ -122,7 +126,7 @@ wheel_fl = PhysicsComponent(
     [
         {
             "brakes.force": 1,
-            "RHS": lambda state: -state["fl_braking"],
+            "RHS": -Symbol("fl_braking"),
         },
         { # Balance torques
             "brakes.force": 1,
@@ -148,11 +152,11 @@ wheel_fl = PhysicsComponent(
         },
         {
             "contact_point_x.force": 1,
-            "RHS": lambda state: state["wheel_fl_x.force"]
+            "RHS": Symbol("wheel_fl_x.force")
         },
         {
             "contact_point_y.force": 1,
-            "RHS": lambda state: state["wheel_fl_y.force"]
+            "RHS": Symbol("wheel_fl_y.force")
         }
     ]
 )
@@ -162,7 +166,7 @@ wheel_fr = PhysicsComponent(
     [
         {
             "brakes.force": 1,
-            "RHS": lambda state: -state["fr_braking"],
+            "RHS": -Symbol("fr_braking"),
         },
         { # Balance torques
             "brakes.force": 1,
@@ -188,11 +192,11 @@ wheel_fr = PhysicsComponent(
         },
         {
             "contact_point_x.force": 1,
-            "RHS": lambda state: state["wheel_fr_x.force"]
+            "RHS": Symbol("wheel_fr_x.force")
         },
         {
             "contact_point_y.force": 1,
-            "RHS": lambda state: state["wheel_fr_y.force"]
+            "RHS": Symbol("wheel_fr_y.force")
         }
     ]
 )
@@ -202,7 +206,7 @@ wheel_rl = PhysicsComponent(
     [
         { # Brake force
             "brakes.force": 1,
-            "RHS": lambda state: -state["rl_braking"],
+            "RHS": -Symbol("rl_braking"),
         },
         { # Balance torques
             "shaft_in.force": 1,
@@ -229,11 +233,11 @@ wheel_rl = PhysicsComponent(
         },
         {
             "contact_point_x.force": 1,
-            "RHS": lambda state: state["wheel_rl_x.force"]
+            "RHS": Symbol("wheel_rl_x.force")
         },
         {
             "contact_point_y.force": 1,
-            "RHS": lambda state: state["wheel_rl_y.force"]
+            "RHS": Symbol("wheel_rl_y.force")
         }
     ]
 )
@@ -243,7 +247,7 @@ wheel_rr = PhysicsComponent(
     [
         { # Brake force
             "brakes.force": 1,
-            "RHS": lambda state: -state["rr_braking"],
+            "RHS": -Symbol("rr_braking"),
         },
         { # Balance torques
             "shaft_in.force": 1,
@@ -270,11 +274,11 @@ wheel_rr = PhysicsComponent(
         },
         {
             "contact_point_x.force": 1,
-            "RHS": lambda state: state["wheel_rr_x.force"]
+            "RHS": Symbol("wheel_rr_x.force")
         },
         {
             "contact_point_y.force": 1,
-            "RHS": lambda state: state["wheel_rr_y.force"]
+            "RHS": Symbol("wheel_rr_y.force")
         }
     ]
 )
@@ -293,22 +297,22 @@ body = PhysicsComponent(
         {
             "wheel_rl_x.acc": 1,
             "cg_x.acc": -1,
-            "RHS": lambda state: get_centrifugal_acc(state, "wheel_rl_x"),
+            "RHS": get_centrifugal_acc("wheel_rl_x"),
         },
         {
             "wheel_rr_x.acc": 1,
             "cg_x.acc": -1,
-            "RHS": lambda state: get_centrifugal_acc(state, "wheel_rr_x"),
+            "RHS": get_centrifugal_acc("wheel_rr_x"),
         },
         {
             "wheel_fl_x.acc": 1,
             "cg_x.acc": -1,
-            "RHS": lambda state: get_centrifugal_acc(state, "wheel_fl_x"),
+            "RHS": get_centrifugal_acc("wheel_fl_x"),
         },
         {
             "wheel_fr_x.acc": 1,
             "cg_x.acc": -1,
-            "RHS": lambda state: get_centrifugal_acc(state, "wheel_fr_x"),
+            "RHS": get_centrifugal_acc("wheel_fr_x"),
         },
         # Y direction (lateral)
         {
@@ -322,22 +326,22 @@ body = PhysicsComponent(
         {
             "wheel_rl_y.acc": 1,
             "cg_y.acc": -1,
-            "RHS": lambda state: get_centrifugal_acc(state, "wheel_rl_y"),
+            "RHS": get_centrifugal_acc("wheel_rl_y"),
         },
         {
             "wheel_rr_y.acc": 1,
             "cg_y.acc": -1,
-            "RHS": lambda state: get_centrifugal_acc(state, "wheel_rr_y"),
+            "RHS": get_centrifugal_acc("wheel_rr_y"),
         },
         {
             "wheel_fl_y.acc": 1,
             "cg_y.acc": -1,
-            "RHS": lambda state: get_centrifugal_acc(state, "wheel_fl_y"),
+            "RHS": get_centrifugal_acc("wheel_fl_y"),
         },
         {
             "wheel_fr_y.acc": 1,
             "cg_y.acc": -1,
-            "RHS": lambda state: get_centrifugal_acc(state, "wheel_fr_y"),
+            "RHS": get_centrifugal_acc("wheel_fr_y"),
         },
         # Yaw
         {
@@ -380,6 +384,14 @@ system.create_solid_connection(wheel_rl, body, "hub_y", "wheel_rl_y")
 system.create_solid_connection(wheel_rr, body, "hub_y", "wheel_rr_y")
 
 
+# Variables that control the system
+input_variables = {
+    "steering_angle": 0,
+    "throttle": 0.4,
+    "brake": 0,
+    "gear": 1,
+}
+
 # Defining variables of the system. These are the variables that are solved for
 # and updated every timestep.
 state_defining = {
@@ -417,119 +429,119 @@ state_computed = {
 }
 
 sym_A, sym_b, variables = system.create_linear_system()
-def rotate90(vec):
-    return np.array([-vec[1], vec[0]])
-
-
-for t in range(10000):
-
-    # Variables that control the system
-    input_variables = {
-        "steering_angle": 0,
-        "throttle": 0.4,
-        "brake": 0,
-        "gear": 1,
-    }
-
-    state_computed["gear_ratio"] = gear_ratios[input_variables["gear"] - 1]
-
-    rpm = calculate_motor_rpm(input_variables, state_defining)
-    state_computed["motor_torque"] = motor_torque_curve(input_variables["throttle"], rpm)
-
-
+# Pass sparse=True to solve with a sparse LU instead of a dense solve
+compiled_system = system.compile_linear_system(sym_A, sym_b, variables)
+# All quantities live in one flat array, the physics lambdas read it by name
+# through a view.
+layout = StateLayout.from_dicts(input_variables, state_defining, state_computed)
+state_array = layout.new_state({**input_variables, **state_defining, **state_computed})
+state = layout.view(state_array)
+
+# Generate one function that evaluates all the coefficient expressions
+compiled_system.compile_kernel(layout)
+
+defining_vars = [n[:-4] for n in state_defining if n.endswith(".vel")]
+
+
+quadrants = ["fl", "fr", "rl", "rr"]
+wheels = WheelKinematics(
+    [[wheel_positions[f"wheel_{q}_x"], wheel_positions[f"wheel_{q}_y"]] for q in quadrants],
+    wheel_radius,
+    steered=[True, True, False, False],
+    tire_force=calculate_slip_force,
+)
+body_vel_index = layout.indices(["body.cg_x.vel", "body.cg_y.vel"])
+wheel_speed_index = layout.indices([f"wheel_{q}.shaft_in.vel" for q in quadrants])
+tire_force_index = layout.indices([f"wheel_{q}_{axis}.force" for q in quadrants for axis in "xy"])
+braking_index = layout.indices([f"{q}_braking" for q in quadrants])
+
+
+def update_computed_state(t, state):
+    # Works on a single state and on batches of states alike
+    y = state.array
+
+    state["gear_ratio"] = powertrain.gear_ratios[np.asarray(state["gear"]).astype(int) - 1]
+
+    rpm = calculate_motor_rpm(state)
+    state["motor_torque"] = powertrain.motor_torque(rpm, state["throttle"])
+
+    wheel_speed = y[..., wheel_speed_index]
+    forces = wheels.tire_forces(
+        y[..., body_vel_index],
+        state["body.yaw.vel"],
+        wheel_speed,
+        state["steering_angle"],
+    )
+    y[..., tire_force_index] = forces.reshape(forces.shape[:-2] + (-1,))
+
+    brake = np.expand_dims(state["brake"], -1)
+    y[..., braking_index] = -brake * max_braking_torque * np.sign(wheel_speed)
+
+
+def body_kinematics(t, state, derivative):
+    # The body velocities are in the car frame, the positions in the world frame
+    yaw = state["body.yaw.pos"]
+    body_v_x = state["body.cg_x.vel"]
+    body_v_y = state["body.cg_y.vel"]
+    derivative["body.cg_x.pos"] = np.cos(yaw) * body_v_x - np.sin(yaw) * body_v_y
+    derivative["body.cg_y.pos"] = np.sin(yaw) * body_v_x + np.cos(yaw) * body_v_y
+
+
+# The integrator only needs the accelerations of the defining variables, so the
+# rest of the system is condensed away once up front. The reference state needs
+# its computed quantities (gear ratio and so on) filled in, otherwise every
+# solve pays for the coupling correction.
+update_computed_state(0, state)
+condensed_system = compiled_system.condense(
+    [name + ".acc" for name in defining_vars],
+    state,
+)
 
-    for quadrant in ["fl", "fr", "rl", "rr"]:
-        wheel_name = f"wheel_{quadrant}"
-        body_v_x = state_defining["body.cg_x.vel"]
-        body_v_y = state_defining["body.cg_y.vel"]
-        body_vel = np.array([body_v_x, body_v_y])
-        wheel_local_pos_x = wheel_positions[f"wheel_{quadrant}_x"]
-        wheel_local_pos_y = wheel_positions[f"wheel_{quadrant}_y"]
-        wheel_local_pos = np.array([wheel_local_pos_x, wheel_local_pos_y])
-        yaw_rate = state_defining["body.yaw.vel"]
-        wheel_vel = body_vel + yaw_rate * rotate90(wheel_local_pos)
-        rot_speed = state_defining[f"wheel_{quadrant}.shaft_in.vel"]
 
-        steering_angle = 0
-        if quadrant in ["fl", "fr"]:
-            steering_angle = input_variables["steering_angle"]
-        
-        rot_mat = np.array([
-            [np.cos(steering_angle), np.sin(steering_angle)],
-            [-np.sin(steering_angle), np.cos(steering_angle)]
-        ])
-        slip_vel = wheel_vel - rot_mat @ np.array([1,0]) * rot_speed * wheel_radius
+dynamics = PhysicsDynamics(
+    condensed_system,
+    layout,
+    [name + ".vel" for name in defining_vars],
+    compute_state=update_computed_state,
+    kinematics=body_kinematics,
+    vectorized=True,
+)
 
-        force = calculate_slip_force(slip_vel)
-        state_computed[f"{wheel_name}_x.force"] = force[0]
-        state_computed[f"{wheel_name}_y.force"] = force[1]
+# The slip forces make the light front wheels stiff, so the explicit schemes
+# (e.g. SemiImplicitEuler) go unstable unless dt is around 1 ms. The linearly
+# implicit scheme stays stable at 5-10 ms.
+integrator = LinearlyImplicitEuler()
+dt = 0.01
+duration = 10
 
-        braking_torque = -input_variables["brake"] * max_braking_torque * np.sign(rot_speed)
-        state_computed[f"{quadrant}_braking"] = braking_torque
 
-    state = {**input_variables, **state_defining, **state_computed}
+# The defining velocities are logged every step, the full state every 10th
+steps = int(duration/dt)
+velocity_names = [name + ".vel" for name in defining_vars]
+velocity_index = layout.indices(velocity_names)
+telemetry = Telemetry(
+    [
+        ("time", float),
+        ("velocities", float, (len(velocity_names),)),
+        ("state", float, (len(layout),), 10),
+    ],
+    capacity=steps,
+)
 
 
-    A, b = system.numeric_linear_system(sym_A, sym_b, state)
+for step in range(steps):
 
     # t0 = timer()
     # t1 = timer()
     # print("Time:", round(1e3*(t1 - t0),2), "ms")
 
-
-    x = solve(A, b)
-    # x = lstsq(A, b)[0]
+    state_array[:] = integrator.step(dynamics, step*dt, state_array, dt)
+    telemetry.record(time=(step + 1)*dt, velocities=state_array[velocity_index], state=state_array)
 
 
-    # all_variables = dict(zip(variables, x))
+    # all_variables = dict(zip(variables, condensed_system.recover(state)))
     # for name in all_variables:
     #     print(name, round(all_variables[name], 2))
 
-    # print("Changes:")
-    
-    # Update state
-    dt = 0.001
-    
-    defining_vars = [n[:-4] for n in state_defining if n.endswith(".vel")]
-    for name in defining_vars:
-        # TODO: This uses Euler forward, leads to instability for the lighter
-        # front wheels. Possible solutions:
-        # - Use a more stable integration method (e.g. Runge-Kutta, Leapfrog)
-        # - Linearize everything and use a linear solver
-        # - Do an ad hoc fix by checking if the slip for the front wheels 
-        #   changes direction. (Cheap, but might work well enough)
-
-
-
-        state_defining[name + ".vel"] += x[variables.index(name + ".acc")]*dt
-        print(name + ".vel", round(state_defining[name + ".vel"], 2))
-    
-    d_pos_local = np.array([
-        state_defining["body.cg_x.vel"]*dt,
-        state_defining["body.cg_y.vel"]*dt,
-    ])
-
-    yaw = state_defining["body.yaw.pos"]
-    yaw_rot_mat = np.array([
-        [np.cos(yaw), -np.sin(yaw)],
-        [np.sin(yaw), np.cos(yaw)]
-    ])
-    d_pos_global = yaw_rot_mat @ d_pos_local
-    state_defining["body.cg_x.pos"] += d_pos_global[0]
-    state_defining["body.cg_y.pos"] += d_pos_global[1]
-    
-    state_defining["body.yaw.pos"] += state_defining["body.yaw.vel"] * dt
-
-    # print("")
-
-for name in defining_vars:
-    print(name + ".vel", round(state_defining[name + ".vel"], 2))
-
-
-
-
-
-
-
-
-
+for name, value in zip(velocity_names, telemetry["velocities"][-1]):
+    print(name, round(value, 2))
@@ -0,0 +1,175 @@
+import numpy as np
+from interpolation import RegularGrid
+
+
+RPM_PER_RAD_S = 60 / (2 * np.pi)
+
+
+class TorqueMap:
+    """Engine torque tabulated on a regular (rpm, throttle) grid, evaluated
+    with vectorized bilinear interpolation.
+
+    torque has shape (len(rpm), len(throttle)). Inputs outside the grid are
+    clamped to its edges; the rev limiter is handled by Powertrain, not by the
+    map. Both axes must be evenly spaced so a lookup is a multiply and a
+    gather instead of a search.
+    """
+
+    def __init__(self, rpm, throttle, torque) -> None:
+        self.grid = RegularGrid((rpm, throttle), name="Torque map")
+        self.axes = self.grid.axes
+        self.torque = np.asarray(torque, dtype=float)
+        if self.torque.shape != self.grid.shape:
+            raise ValueError(f"Torque table has shape {self.torque.shape}, expected {self.grid.shape}")
+
+
+    @classmethod
+    def from_function(cls, function, max_rpm, rpm_points=81, throttle_points=11):
+        """Tabulates function(throttle, rpm) on [0, max_rpm] x [0, 1]."""
+        rpm = np.linspace(0, max_rpm, rpm_points)
+        throttle = np.linspace(0, 1, throttle_points)
+        return cls(rpm, throttle, function(throttle[None, :], rpm[:, None]))
+
+
+    @classmethod
+    def flat(cls, max_torque, max_rpm):
+        """Torque proportional to throttle and independent of rpm. The map is
+        linear in throttle, so it is evaluated directly instead of
+        interpolated."""
+        return FlatTorqueMap(max_torque, max_rpm)
+
+
+    @property
+    def max_torque(self):
+        return self.torque.max()
+
+
+    def __call__(self, rpm, throttle):
+        """Returns the interpolated torque. Arguments broadcast."""
+        return self.grid.interpolate(self.torque, rpm, throttle)
+
+
+class FlatTorqueMap(TorqueMap):
+    """TorqueMap.flat: max_torque * throttle at any rpm, with the throttle
+    clamped to [0, 1] like the grid of a tabulated map."""
+
+    def __init__(self, max_torque, max_rpm) -> None:
+        super().__init__([0, max_rpm], [0, 1], [[0, max_torque], [0, max_torque]])
+        self._max_torque = float(max_torque)
+
+
+    def __call__(self, rpm, throttle):
+        """Returns the torque. Arguments broadcast."""
+        torque = np.clip(throttle, 0, 1) * self._max_torque
+        if np.shape(rpm) != np.shape(torque):
+            torque = np.broadcast_to(torque, np.broadcast_shapes(np.shape(rpm), np.shape(torque)))
+        return torque
+
+
+class Powertrain:
+    """Engine torque map, gearbox and driven wheels for any number of cars.
+
+    gear_ratios are the overall ratios between motor and wheel speed, indexed
+    by a zero based gear. Every method takes arrays with one entry per car
+    (or scalars) and broadcasts, so a whole batch is evaluated in one call.
+    Above max_rpm the rev limiter cuts the torque.
+    """
+
+    def __init__(self, torque_map, gear_ratios, wheel_radius, max_rpm=None) -> None:
+        self.torque_map = torque_map
+        self.gear_ratios = np.asarray(gear_ratios, dtype=float)
+        self.wheel_radius = wheel_radius
+        self.max_rpm = torque_map.axes[0][-1] if max_rpm is None else max_rpm
+
+
+    def __len__(self):
+        return len(self.gear_ratios)
+
+
+    def rpm_from_wheel_speed(self, wheel_speed, gear):
+        """Motor rpm for a driven wheel angular speed in rad/s."""
+        return wheel_speed * self.gear_ratios[gear] * RPM_PER_RAD_S
+
+
+    def motor_rpm(self, long_vel, gear):
+        """Motor rpm for a longitudinal speed in m/s, assuming the wheels roll."""
+        return self.rpm_from_wheel_speed(long_vel / self.wheel_radius, gear)
+
+
+    def motor_torque(self, rpm, throttle):
+        """Torque at the motor shaft, zero above the rev limit."""
+        return np.where(rpm > self.max_rpm, 0, self.torque_map(rpm, throttle))
+
+
+    def wheel_force(self, long_vel, throttle, gear):
+        """Returns (force, rpm): the tractive force at the contact patch and
+        the motor rpm."""
+        rpm = self.motor_rpm(long_vel, gear)
+        force = self.motor_torque(rpm, throttle) * self.gear_ratios[gear] / self.wheel_radius
+        return force, rpm
+
+
+    def optimal_gear(self, long_vel, throttle=1):
+        """Gear giving the largest tractive force without passing the rev
+        limit, evaluated for all gears at once. Cars too fast for every gear
+        get the top gear."""
+        long_vel = np.asarray(long_vel)[..., None]
+        throttle = np.asarray(throttle)[..., None]
+        gears = np.arange(len(self.gear_ratios))
+        force, rpm = self.wheel_force(long_vel, throttle, gears)
+        force = np.where(rpm > self.max_rpm, -np.inf, force)
+        best = np.argmax(force, axis=-1)
+        return np.where(np.isfinite(np.max(force, axis=-1)), best, len(self.gear_ratios) - 1)
+
+
+class Transmission:
+    """Automatic shift scheduler for any number of cars.
+
+    Shifts up when the rpm passes upshift_rpm and down when it falls below
+    downshift_rpm, or below brake_downshift_rpm while braking. A downshift is
+    only taken if the rpm in the lower gear stays hysteresis_rpm below the
+    upshift point, so the gearbox never hunts between two gears. Each shift
+    takes shift_time seconds, during which the drive torque is cut and no
+    other shift starts. Thresholds default to fractions of the rev limit.
+    """
+
+    def __init__(
+            self,
+            powertrain,
+            upshift_rpm=None,
+            downshift_rpm=None,
+            brake_downshift_rpm=None,
+            hysteresis_rpm=None,
+            shift_time=0.2,
+            ) -> None:
+        max_rpm = powertrain.max_rpm
+        self.powertrain = powertrain
+        self.upshift_rpm = 0.9 * max_rpm if upshift_rpm is None else upshift_rpm
+        self.downshift_rpm = 0.4 * max_rpm if downshift_rpm is None else downshift_rpm
+        self.brake_downshift_rpm = 0.6 * max_rpm if brake_downshift_rpm is None else brake_downshift_rpm
+        self.hysteresis_rpm = 0.1 * max_rpm if hysteresis_rpm is None else hysteresis_rpm
+        self.shift_time = shift_time
+
+
+    def update(self, gear, shift_timer, long_vel, brake, dt):
+        """Returns the new (gear, shift_timer) after dt seconds. All arguments
+        broadcast, gear is zero based."""
+        powertrain = self.powertrain
+        top_gear = len(powertrain) - 1
+        shift_timer = np.maximum(shift_timer - dt, 0)
+        ready = shift_timer <= 0
+
+        rpm = powertrain.motor_rpm(long_vel, gear)
+        upshift = ready & (rpm > self.upshift_rpm) & (gear < top_gear)
+
+        lower_rpm = powertrain.motor_rpm(long_vel, np.maximum(gear - 1, 0))
+        downshift_rpm = np.where(brake > 0, self.brake_downshift_rpm, self.downshift_rpm)
+        downshift = (
+            ready & ~upshift & (gear > 0)
+            & (rpm < downshift_rpm)
+            & (lower_rpm < self.upshift_rpm - self.hysteresis_rpm)
+        )
+
+        gear = gear + upshift.astype(int) - downshift.astype(int)
+        shift_timer = np.where(upshift | downshift, self.shift_time, shift_timer)
+        return gear, shift_timer
@@ -0,0 +1,236 @@
+import multiprocessing as mp
+import traceback
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait as wait_connections
+
+import numpy as np
+from env import VectorCarEnv
+
+
+# Commands sent to the workers. Only these short tags go through the pipes,
+# the data itself stays in shared memory.
+_RESET = "reset"
+_STEP = "step"
+_CLOSE = "close"
+
+
+class SharedArray:
+    """NumPy array backed by a multiprocessing.shared_memory block.
+
+    A worker attaches to an existing block with SharedArray(*descriptor),
+    where the descriptor holds only the block name, shape and dtype. The
+    SharedArray that created the block unlinks it in close().
+    """
+
+    def __init__(self, shape, dtype=float, name=None) -> None:
+        self.shape = tuple(np.atleast_1d(shape))
+        self.dtype = np.dtype(dtype)
+        self._owner = name is None
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.memory = shared_memory.SharedMemory(name=name, create=self._owner, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+        if self._owner:
+            self.array[...] = 0
+
+
+    @property
+    def descriptor(self):
+        return self.shape, self.dtype, self.memory.name
+
+
+    def close(self):
+        self.array = None
+        self.memory.close()
+        if self._owner:
+            self.memory.unlink()
+
+
+def _worker(env_slice, descriptors, env_factory, env_kwargs, connection):
+    buffers = {}
+    try:
+        for name, descriptor in descriptors.items():
+            buffers[name] = SharedArray(*descriptor)
+        arrays = {name: buffer.array[env_slice] for name, buffer in buffers.items()}
+        env = env_factory(env_slice.stop - env_slice.start, **env_kwargs)
+        # The environment writes its results in place, so pointing its result
+        # arrays at the shared slices makes every step land in shared memory.
+        for name in ("observations", "final_observations", "rewards", "terminated", "truncated"):
+            setattr(env, name, arrays[name])
+        actions = arrays["actions"]
+
+        while True:
+            command = connection.recv()
+            if command == _STEP:
+                env.step(actions)
+            elif command == _RESET:
+                env.reset()
+            elif command == _CLOSE:
+                break
+            connection.send(None)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    except Exception:
+        connection.send(traceback.format_exc())
+    finally:
+        for buffer in buffers.values():
+            buffer.close()
+        connection.close()
+
+
+class RolloutWorkers:
+    """Steps n_envs environments sharded across a pool of worker processes.
+
+    Each worker owns a contiguous slice of the environments and runs one
+    env_factory(n, **env_kwargs) vectorized environment on it, VectorCarEnv by
+    default. Actions, observations, rewards and done flags are exchanged
+    through shared memory arrays covering all environments, the pipes to the
+    workers only carry command tags.
+
+    step() advances all workers in lockstep. For asynchronous stepping, write
+    the actions of some workers' slices, call step_async(workers) and collect
+    finished workers with wait(); their slices of the result arrays are then
+    valid until they are stepped again.
+    """
+
+    def __init__(
+            self,
+            n_envs,
+            n_workers=None,
+            env_factory=VectorCarEnv,
+            env_kwargs=None,
+            start_method=None,
+            ) -> None:
+        n_workers = min(n_envs, n_workers or mp.cpu_count())
+        env_kwargs = {} if env_kwargs is None else env_kwargs
+
+        # Query the sizes from a one car environment instead of hard coding them
+        probe = env_factory(1, **env_kwargs)
+        self.n_envs = n_envs
+        self.observation_size = probe.observation_size
+        self.action_size = probe.action_size
+
+        self._buffers = {
+            "actions": SharedArray((n_envs, self.action_size)),
+            "observations": SharedArray((n_envs, self.observation_size)),
+            "final_observations": SharedArray((n_envs, self.observation_size)),
+            "rewards": SharedArray(n_envs),
+            "terminated": SharedArray(n_envs, bool),
+            "truncated": SharedArray(n_envs, bool),
+        }
+        self.actions = self._buffers["actions"].array
+        self.observations = self._buffers["observations"].array
+        self.final_observations = self._buffers["final_observations"].array
+        self.rewards = self._buffers["rewards"].array
+        self.terminated = self._buffers["terminated"].array
+        self.truncated = self._buffers["truncated"].array
+
+        bounds = np.linspace(0, n_envs, n_workers + 1).astype(int).tolist()
+        self.slices = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        descriptors = {name: buffer.descriptor for name, buffer in self._buffers.items()}
+        context = mp.get_context(start_method)
+        self._connections = []
+        self._processes = []
+        for env_slice in self.slices:
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=_worker,
+                args=(env_slice, descriptors, env_factory, env_kwargs, child),
+                daemon=True,
+            )
+            process.start()
+            child.close()
+            self._connections.append(parent)
+            self._processes.append(process)
+        self._pending = set()
+        self.closed = False
+
+
+    def __len__(self):
+        return self.n_envs
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @property
+    def n_workers(self):
+        return len(self._processes)
+
+
+    def _send(self, command, workers):
+        for worker in workers:
+            if worker in self._pending:
+                raise RuntimeError(f"Worker {worker} is still busy, wait() for it first")
+            self._connections[worker].send(command)
+            self._pending.add(worker)
+
+
+    def _receive(self, worker):
+        message = self._connections[worker].recv()
+        self._pending.discard(worker)
+        if message is not None:
+            raise RuntimeError(f"Rollout worker {worker} failed:\n{message}")
+
+
+    def reset(self):
+        workers = range(self.n_workers)
+        self._send(_RESET, workers)
+        for worker in workers:
+            self._receive(worker)
+        return self.observations
+
+
+    def step(self, actions=None):
+        """Steps every environment once with actions (or with the contents of
+        self.actions when None) and returns (observations, rewards,
+        terminated, truncated, final_observations). The returned arrays are
+        the shared buffers and are overwritten by the next step."""
+        if actions is not None:
+            self.actions[:] = actions
+        self.step_async()
+        while self._pending:
+            self.wait()
+        return self.observations, self.rewards, self.terminated, self.truncated, self.final_observations
+
+
+    def step_async(self, workers=None):
+        """Starts a step on the given workers (all when None) with the actions
+        currently in their slices of self.actions."""
+        self._send(_STEP, range(self.n_workers) if workers is None else workers)
+
+
+    def wait(self, timeout=None):
+        """Blocks until at least one busy worker finishes and returns the
+        finished worker indices. Returns an empty list on timeout."""
+        pending = {self._connections[worker]: worker for worker in self._pending}
+        ready = [pending[connection] for connection in wait_connections(list(pending), timeout)]
+        for worker in ready:
+            self._receive(worker)
+        return sorted(ready)
+
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for worker, connection in enumerate(self._connections):
+            try:
+                if worker in self._pending:
+                    connection.recv()
+                connection.send(_CLOSE)
+            except (BrokenPipeError, EOFError):
+                pass
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for connection in self._connections:
+            connection.close()
+        for buffer in self._buffers.values():
+            buffer.close()
@@ -0,0 +1,186 @@
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+
+
+def _npy_header(dtype, length, size=None):
+    """Header of a .npy file holding length records of dtype. The header is
+    padded to size bytes so it can be rewritten in place once the final
+    length is known; by default it leaves room for any length."""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        np.lib.format.dtype_to_descr(dtype), length
+    )
+    # Version 1.0 stores the header length in 2 bytes, 2.0 in 4
+    version, length_format = (1, "<H") if len(header) < 65000 else (2, "<I")
+    preamble_size = 8 + struct.calcsize(length_format)
+    if size is None:
+        size = -(-(preamble_size + len(header) + 21) // 64) * 64
+    header = header.ljust(size - preamble_size - 1) + "\n"
+    return (
+        b"\x93NUMPY" + bytes([version, 0])
+        + struct.pack(length_format, len(header))
+        + header.encode("latin1")
+    )
+
+
+def _channel_spec(channel):
+    """Normalizes name, (name, dtype), (name, dtype, shape) or
+    (name, dtype, shape, decimation) to the full 4-tuple."""
+    if isinstance(channel, str):
+        channel = (channel,)
+    name, dtype, shape, decimation = tuple(channel) + (float, (), 1)[len(channel) - 1:]
+    return name, dtype, shape, int(decimation)
+
+
+class _Group:
+    """Channels sharing a decimation, stored as rows of one structured array."""
+
+    def __init__(self, decimation, channels, rows) -> None:
+        self.decimation = decimation
+        self.names = [name for name, _, _ in channels]
+        self.dtype = np.dtype([("step", np.int64)] + [(name, dtype, shape) for name, dtype, shape in channels])
+        self.buffer = np.zeros(rows, dtype=self.dtype)
+        self.index = 0
+        self.count = 0
+        self.file = None
+        self.header_size = 0
+
+
+class Telemetry:
+    """Recorder for a declared list of channels.
+
+    A channel is a name, (name, dtype), (name, dtype, shape) or
+    (name, dtype, shape, decimation); a channel with decimation d is recorded
+    on every d-th call of record(). Channels sharing a decimation are stored
+    together as the rows of one structured array, with the step number in an
+    extra "step" field, so recording a sample is a single row assignment.
+
+    Without a path the recorder is a ring buffer that keeps the last capacity
+    samples of every channel, read back in chronological order with
+    telemetry[name]. With a path, samples are collected in chunks of
+    chunk_size rows that a background thread appends to one .npy file per
+    decimation, <path>_<decimation>.npy, while recording continues into a
+    fresh chunk. close() writes the remaining rows and fixes the file
+    headers, after which Telemetry.load reads the files back.
+    """
+
+    def __init__(self, channels, capacity=10000, path=None, chunk_size=4096) -> None:
+        groups = {}
+        for channel in channels:
+            name, dtype, shape, decimation = _channel_spec(channel)
+            if decimation < 1:
+                raise ValueError(f"Channel {name} has decimation {decimation}, it must be at least 1")
+            groups.setdefault(decimation, []).append((name, dtype, shape))
+
+        self.path = path
+        self.step = 0
+        rows = capacity if path is None else chunk_size
+        self._groups = [_Group(decimation, groups[decimation], rows) for decimation in sorted(groups)]
+        self._group_of = {name: group for group in self._groups for name in group.names}
+        self.closed = False
+
+        if path is not None:
+            for group in self._groups:
+                group.file = open(self.file_path(path, group.decimation), "wb")
+                header = _npy_header(group.dtype, 0)
+                group.header_size = len(header)
+                group.file.write(header)
+            self._queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_chunks, daemon=True)
+            self._writer.start()
+
+
+    @staticmethod
+    def file_path(path, decimation=1):
+        root, _ = os.path.splitext(path)
+        return f"{root}_{decimation}.npy"
+
+
+    @staticmethod
+    def load(path, decimation=1, mmap_mode=None):
+        """Reads back the structured array a streaming recorder wrote for the
+        channels of one decimation."""
+        return np.load(Telemetry.file_path(path, decimation), mmap_mode=mmap_mode)
+
+
+    @property
+    def channels(self):
+        return list(self._group_of)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def record(self, **values):
+        """Records one sample of every channel due at this step. Channels of
+        the due groups must all be given, others may be left out."""
+        step = self.step
+        self.step += 1
+        for group in self._groups:
+            if step % group.decimation:
+                continue
+            group.buffer[group.index] = (step, *[values[name] for name in group.names])
+            group.index += 1
+            group.count += 1
+            if group.index == len(group.buffer):
+                if self.path is None:
+                    group.index = 0
+                else:
+                    self._flush(group)
+
+
+    def _flush(self, group):
+        if group.index:
+            self._queue.put((group.file, group.buffer[:group.index]))
+            group.buffer = np.zeros(len(group.buffer), dtype=group.dtype)
+            group.index = 0
+
+
+    def _write_chunks(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            file, chunk = item
+            file.write(chunk.tobytes())
+
+
+    def _rows(self, group):
+        if self.path is not None:
+            raise ValueError("A streaming recorder keeps no history in memory, use Telemetry.load")
+        if group.count <= len(group.buffer):
+            return group.buffer[:group.count]
+        return np.concatenate([group.buffer[group.index:], group.buffer[:group.index]])
+
+
+    def __getitem__(self, name):
+        """Recorded values of a channel, oldest first."""
+        return self._rows(self._group_of[name])[name]
+
+
+    def steps(self, name):
+        """Step numbers at which a channel was recorded, oldest first."""
+        return self._rows(self._group_of[name])["step"]
+
+
+    def close(self):
+        if self.closed or self.path is None:
+            self.closed = True
+            return
+        self.closed = True
+        for group in self._groups:
+            self._flush(group)
+        self._queue.put(None)
+        self._writer.join()
+        for group in self._groups:
+            group.file.seek(0)
+            group.file.write(_npy_header(group.dtype, group.count, group.header_size))
+            group.file.close()
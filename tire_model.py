@@ -1,14 +1,136 @@
+import numpy as np
+from interpolation import RegularGrid
 
 
+def slip_quantities(long_vel, lat_vel, wheel_speed, wheel_radius, min_speed=0.5):
+    """Returns (slip_ratio, slip_angle) of a wheel.
 
+    long_vel and lat_vel are the velocity of the wheel center in the wheel
+    frame and wheel_speed the angular speed of the wheel. The longitudinal
+    speed in the denominators is limited to min_speed so the slip stays finite
+    at standstill. All arguments broadcast."""
+    reference_speed = np.maximum(np.abs(long_vel), min_speed)
+    slip_ratio = (wheel_speed * wheel_radius - long_vel) / reference_speed
+    slip_angle = np.arctan2(lat_vel, reference_speed)
+    return slip_ratio, slip_angle
 
 
+def exponential_slip_force(slip_vel, normal_force, mu):
+    """Simple saturating friction model: the force opposes the slip velocity
+    with magnitude (1 - exp(-|slip|)) * mu * normal_force.
 
+    slip_vel has shape (..., 2), zero slip gives zero force."""
+    slip_norm = np.linalg.norm(slip_vel, axis=-1, keepdims=True)
+    safe_norm = np.where(slip_norm == 0, 1, slip_norm)
+    force_magnitude = (1 - np.exp(-slip_norm)) * mu * np.expand_dims(normal_force, -1)
+    return -slip_vel / safe_norm * force_magnitude
 
 
+class MagicFormulaTire:
+    """Combined slip Pacejka Magic Formula tire.
 
+    The pure slip forces are
 
+        F = D sin(C atan(B s - E (B s - atan(B s))))
 
+    with s the slip ratio (longitudinal) or slip angle (lateral). The peak D
+    is mu * Fz with mu falling off linearly with the load relative to
+    nominal_load (load_sensitivity). For combined slip each pure force is
+    scaled by a cosine weighting function of the other slip quantity.
 
+    The longitudinal force is positive when the wheel spins faster than it
+    rolls (driving), and the lateral force opposes the slip angle. Every
+    method works on arrays of any shape, so all wheels of all cars can be
+    evaluated in one call.
+    """
 
+    def __init__(
+            self,
+            mu=1.0,
+            nominal_load=3680.0,
+            load_sensitivity=-0.1,
+            B_x=10.0,
+            C_x=1.9,
+            E_x=0.97,
+            B_y=8.5,
+            C_y=1.3,
+            E_y=-0.5,
+            B_x_alpha=8.0,
+            C_x_alpha=1.0,
+            B_y_kappa=6.0,
+            C_y_kappa=1.0,
+            ) -> None:
+        self.mu = mu
+        self.nominal_load = nominal_load
+        self.load_sensitivity = load_sensitivity
+        self.B_x = B_x
+        self.C_x = C_x
+        self.E_x = E_x
+        self.B_y = B_y
+        self.C_y = C_y
+        self.E_y = E_y
+        self.B_x_alpha = B_x_alpha
+        self.C_x_alpha = C_x_alpha
+        self.B_y_kappa = B_y_kappa
+        self.C_y_kappa = C_y_kappa
 
+
+    def peak_force(self, normal_load):
+        normal_load = np.maximum(normal_load, 0)
+        load_change = (normal_load - self.nominal_load) / self.nominal_load
+        return self.mu * (1 + self.load_sensitivity * load_change) * normal_load
+
+
+    @staticmethod
+    def _magic_formula(slip, B, C, D, E):
+        Bs = B * slip
+        return D * np.sin(C * np.arctan(Bs - E * (Bs - np.arctan(Bs))))
+
+
+    def pure_forces(self, slip_ratio, slip_angle, normal_load):
+        """Returns the (fx, fy) forces without combined slip weighting."""
+        D = self.peak_force(normal_load)
+        fx = self._magic_formula(slip_ratio, self.B_x, self.C_x, D, self.E_x)
+        fy = -self._magic_formula(slip_angle, self.B_y, self.C_y, D, self.E_y)
+        return fx, fy
+
+
+    def forces(self, slip_ratio, slip_angle, normal_load):
+        """Returns the combined slip (fx, fy) forces in the wheel frame."""
+        fx, fy = self.pure_forces(slip_ratio, slip_angle, normal_load)
+        fx = fx * np.cos(self.C_x_alpha * np.arctan(self.B_x_alpha * slip_angle))
+        fy = fy * np.cos(self.C_y_kappa * np.arctan(self.B_y_kappa * slip_ratio))
+        return fx, fy
+
+
+class TireLookupTable:
+    """Precomputed tire forces on a regular (slip ratio, slip angle, normal
+    load) grid, evaluated with vectorized trilinear interpolation.
+
+    Inputs outside the grid are clamped to its edges, so the grid should span
+    the slip range the simulation reaches. The interpolation is not cheaper
+    than evaluating MagicFormulaTire directly, so the table is only worth it
+    for tire models that are expensive to evaluate, such as fitted or
+    measured data.
+    """
+
+    def __init__(
+            self,
+            tire,
+            slip_ratios=np.linspace(-1, 1, 81),
+            slip_angles=np.linspace(-np.pi / 4, np.pi / 4, 61),
+            normal_loads=np.linspace(0, 10000, 11),
+            ) -> None:
+        self.grid = RegularGrid((slip_ratios, slip_angles, normal_loads))
+        self.axes = self.grid.axes
+
+        grid = np.meshgrid(*self.axes, indexing="ij")
+        fx, fy = tire.forces(*grid)
+        # Both forces in one table so a single gather serves both
+        self.table = np.stack([fx, fy], axis=-1)
+
+
+    def forces(self, slip_ratio, slip_angle, normal_load):
+        """Returns the interpolated (fx, fy) forces. Arguments broadcast."""
+        forces = self.grid.interpolate(self.table, slip_ratio, slip_angle, normal_load)
+        return forces[..., 0], forces[..., 1]
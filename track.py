@@ -0,0 +1,282 @@
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class SegmentGrid:
+    """Uniform grid spatial index over a set of line segments.
+
+    Every cell lists the segments whose bounding box, grown by padding,
+    overlaps it. A point within padding of a segment therefore finds that
+    segment among the candidates of its own cell, and a query only looks at a
+    handful of segments instead of all of them. Points further than padding
+    from every segment fall back to a KD-tree over the segment midpoints, so
+    results are exact either way. The cell lists are stored flat (CSR style) so queries
+    for many points are a few vectorized gathers.
+    """
+
+    def __init__(self, starts, ends, padding, cell_size=None, max_cells=1 << 22) -> None:
+        self.starts = np.asarray(starts, dtype=float)
+        self.ends = np.asarray(ends, dtype=float)
+        self.padding = padding
+        self.directions = self.ends - self.starts
+        length_squared = np.sum(self.directions**2, axis=-1)
+        self.inverse_length_squared = 1 / np.where(length_squared == 0, 1, length_squared)
+        self.max_half_length = np.sqrt(length_squared.max()) / 2
+        self._midpoint_tree = None
+
+        lower = np.minimum(self.starts, self.ends) - padding
+        upper = np.maximum(self.starts, self.ends) + padding
+        self.origin = lower.min(axis=0)
+        extent = upper.max(axis=0) - self.origin
+
+        if cell_size is None:
+            mean_length = np.mean(np.linalg.norm(self.ends - self.starts, axis=-1))
+            cell_size = max(padding / 2, mean_length)
+        # Never allocate more than max_cells, however small the requested cells
+        cell_size = max(cell_size, np.sqrt(np.prod(extent) / max_cells))
+        self.cell_size = cell_size
+        self.shape = np.maximum(np.ceil(extent / cell_size).astype(int), 1)
+
+        # Enumerate every (cell, segment) overlap without a Python loop
+        low_cell = self._cell_coordinates(lower)
+        high_cell = self._cell_coordinates(upper)
+        span = high_cell - low_cell + 1
+        count = span[:, 0] * span[:, 1]
+        segment = np.repeat(np.arange(len(self.starts)), count)
+        local = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        cell_x = low_cell[segment, 0] + local % span[segment, 0]
+        cell_y = low_cell[segment, 1] + local // span[segment, 0]
+        cell = cell_y * self.shape[0] + cell_x
+
+        order = np.argsort(cell, kind="stable")
+        self.cell_segments = segment[order]
+        self.cell_start = np.zeros(self.shape[0] * self.shape[1] + 1, dtype=int)
+        np.cumsum(np.bincount(cell, minlength=len(self.cell_start) - 1), out=self.cell_start[1:])
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def _cell_coordinates(self, points):
+        cell = np.floor((points - self.origin) / self.cell_size).astype(int)
+        return np.clip(cell, 0, self.shape - 1)
+
+
+    def cells(self, points):
+        """Flat index of the cell containing each (clamped) point."""
+        cell = self._cell_coordinates(points)
+        return cell[..., 1] * self.shape[0] + cell[..., 0]
+
+
+    def cell_members(self, cell):
+        """Returns (query_index, segment_index) pairs listing the segments of
+        each cell in the flat cell array."""
+        first = self.cell_start[cell]
+        count = self.cell_start[cell + 1] - first
+        query = np.repeat(np.arange(len(cell)), count)
+        offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        return query, self.cell_segments[np.repeat(first, count) + offset]
+
+
+    def candidates(self, points):
+        """Returns (point_index, segment_index) pairs listing, for every point
+        of the (P, 2) array, the segments registered in its cell. Pairs are
+        grouped by point."""
+        return self.cell_members(self.cells(points))
+
+
+    def _update_nearest(self, points, point, candidate, segment, t, distance):
+        """Lowers distance (and segment, t) of every point in place wherever
+        one of its candidate segments is closer. point must be sorted."""
+        if not len(point):
+            return
+        relative = points[point] - self.starts[candidate]
+        direction = self.directions[candidate]
+        candidate_t = np.einsum("ij,ij->i", relative, direction) * self.inverse_length_squared[candidate]
+        np.clip(candidate_t, 0, 1, out=candidate_t)
+        relative -= candidate_t[:, None] * direction
+        # Squared distances are enough to pick the closest
+        candidate_distance = np.einsum("ij,ij->i", relative, relative)
+        # The pairs are grouped by point, so the closest candidate of each
+        # point is a segmented minimum.
+        group_start = np.flatnonzero(np.r_[True, point[1:] != point[:-1]])
+        group_min = np.minimum.reduceat(candidate_distance, group_start)
+        group_size = np.diff(np.r_[group_start, len(point)])
+        is_min = np.flatnonzero(candidate_distance == np.repeat(group_min, group_size))
+        first = is_min[np.r_[True, point[is_min][1:] != point[is_min][:-1]]]
+        closer = first[candidate_distance[first] < distance[point[first]] ** 2]
+        segment[point[closer]] = candidate[closer]
+        t[point[closer]] = candidate_t[closer]
+        distance[point[closer]] = np.sqrt(candidate_distance[closer])
+
+
+    def nearest(self, points, k=16):
+        """Returns (segment_index, t, distance) of the closest segment to every
+        point of the (P, 2) array, t being the position along the segment."""
+        points = np.asarray(points, dtype=float)
+        n = len(points)
+        segment = np.zeros(n, dtype=int)
+        t = np.zeros(n)
+        distance = np.full(n, np.inf)
+        self._update_nearest(points, *self.candidates(points), segment, t, distance)
+
+        # Only a segment within padding is guaranteed to be in the own cell.
+        # The other points compare against the segments with the k nearest
+        # midpoints. A segment at distance d has its midpoint within
+        # d + max_half_length, so once the k-th midpoint is further than that
+        # from the best distance, no unseen segment can be closer.
+        remaining = np.flatnonzero(distance > self.padding)
+        if len(remaining) and self._midpoint_tree is None:
+            self._midpoint_tree = cKDTree((self.starts + self.ends) / 2)
+        while len(remaining):
+            k = min(k, len(self))
+            midpoint_distance, candidate = self._midpoint_tree.query(points[remaining], k=k)
+            candidate = np.reshape(candidate, (len(remaining), k))
+            self._update_nearest(points, np.repeat(remaining, k), candidate.ravel(), segment, t, distance)
+            if k == len(self):
+                break
+            unresolved = np.reshape(midpoint_distance, (len(remaining), k))[:, -1] < (
+                distance[remaining] + self.max_half_length
+            )
+            remaining = remaining[unresolved]
+            k *= 4
+        return segment, t, distance
+
+
+class Track:
+    """Race track given by a centerline polyline and the track width.
+
+    The centerline is parameterized by arc length s: arc_length[i] is the
+    distance along the centerline to point i, tangents are the unit
+    directions of the segments and curvature is the signed curvature at the
+    points (positive turning left). The left and right boundary polylines
+    are offset from the centerline along the normals.
+
+    width_left and width_right are the distances from the centerline to the
+    boundaries and may vary per point. For a closed track the last point
+    connects back to the first.
+    """
+
+    def __init__(self, centerline, width_left, width_right=None, closed=True, cell_size=None) -> None:
+        centerline = np.asarray(centerline, dtype=float)
+        width_right = width_left if width_right is None else width_right
+        width_left = np.broadcast_to(np.asarray(width_left, dtype=float), len(centerline))
+        width_right = np.broadcast_to(np.asarray(width_right, dtype=float), len(centerline))
+        if closed and np.allclose(centerline[0], centerline[-1]):
+            centerline, width_left, width_right = centerline[:-1], width_left[:-1], width_right[:-1]
+        if closed:
+            centerline = np.vstack([centerline, centerline[:1]])
+            width_left = np.r_[width_left, width_left[:1]]
+            width_right = np.r_[width_right, width_right[:1]]
+        if len(centerline) < 2:
+            raise ValueError("A track needs at least two centerline points")
+
+        self.closed = closed
+        self.points = centerline
+        self.width_left = width_left
+        self.width_right = width_right
+
+        segments = np.diff(centerline, axis=0)
+        self.segment_length = np.linalg.norm(segments, axis=-1)
+        if np.any(self.segment_length == 0):
+            raise ValueError("The centerline has repeated consecutive points")
+        self.tangents = segments / self.segment_length[:, None]
+        self.arc_length = np.r_[0, np.cumsum(self.segment_length)]
+        self.length = self.arc_length[-1]
+
+        # Point tangents average the neighbouring segments, open ends use
+        # their only segment.
+        previous_tangent = np.vstack([self.tangents[-1:] if closed else self.tangents[:1], self.tangents])
+        next_tangent = np.vstack([self.tangents, self.tangents[:1] if closed else self.tangents[-1:]])
+        point_tangent = previous_tangent + next_tangent
+        point_tangent /= np.linalg.norm(point_tangent, axis=-1, keepdims=True)
+        self.normals = np.stack([-point_tangent[:, 1], point_tangent[:, 0]], axis=-1)
+
+        turn = np.arctan2(
+            previous_tangent[:, 0] * next_tangent[:, 1] - previous_tangent[:, 1] * next_tangent[:, 0],
+            np.sum(previous_tangent * next_tangent, axis=-1),
+        )
+        previous_length = np.r_[self.segment_length[-1] if closed else self.segment_length[0], self.segment_length]
+        next_length = np.r_[self.segment_length, self.segment_length[0] if closed else self.segment_length[-1]]
+        self.curvature = 2 * turn / (previous_length + next_length)
+        if not closed:
+            self.curvature[[0, -1]] = 0
+
+        self.left_boundary = self.points + self.normals * self.width_left[:, None]
+        self.right_boundary = self.points - self.normals * self.width_right[:, None]
+
+        # Every point on the track is within the widest half width of the
+        # centerline, so those queries always hit their own grid cell.
+        self.max_half_width = max(self.width_left.max(), self.width_right.max())
+        self.grid = SegmentGrid(self.points[:-1], self.points[1:], self.max_half_width, cell_size)
+
+
+    @classmethod
+    def load(cls, path, closed=True, cell_size=None):
+        """Loads a track from a .npy or .csv file with rows of x, y and
+        either one width (split evenly to both sides) or the right and left
+        widths, as in x_m, y_m, w_tr_right_m, w_tr_left_m. Lines starting
+        with # are ignored in CSV files."""
+        if os.path.splitext(path)[1] == ".npy":
+            data = np.load(path)
+        else:
+            data = np.loadtxt(path, delimiter=",", comments="#", ndmin=2)
+        if data.ndim != 2 or data.shape[1] not in (3, 4):
+            raise ValueError(f"Expected rows of x, y, width or x, y, width_right, width_left in {path}")
+        if data.shape[1] == 3:
+            return cls(data[:, :2], data[:, 2] / 2, closed=closed, cell_size=cell_size)
+        return cls(data[:, :2], data[:, 3], data[:, 2], closed=closed, cell_size=cell_size)
+
+
+    def __len__(self):
+        return len(self.segment_length)
+
+
+    def wrap(self, s):
+        """Maps arc lengths onto [0, length) on a closed track."""
+        return np.mod(s, self.length) if self.closed else np.clip(s, 0, self.length)
+
+
+    def position(self, s):
+        """Centerline points at arc lengths s, shape (..., 2)."""
+        s = self.wrap(s)
+        return np.stack([np.interp(s, self.arc_length, self.points[:, axis]) for axis in range(2)], axis=-1)
+
+
+    def heading(self, s):
+        """Direction of the centerline at arc lengths s, as a yaw angle
+        measured from the x axis."""
+        segment = np.clip(np.searchsorted(self.arc_length, self.wrap(s), side="right") - 1, 0, len(self) - 1)
+        tangent = self.tangents[segment]
+        return np.arctan2(tangent[..., 1], tangent[..., 0])
+
+
+    def curvature_at(self, s):
+        return np.interp(self.wrap(s), self.arc_length, self.curvature)
+
+
+    def project(self, positions):
+        """Projects positions of shape (..., 2), e.g. CarBatch.pos, onto the
+        centerline. Returns (progress, lateral_offset, segment_index), with
+        progress the arc length of the closest centerline point and the
+        offset positive to the left of the driving direction."""
+        positions = np.asarray(positions, dtype=float)
+        flat = positions.reshape(-1, 2)
+        segment, t, _ = self.grid.nearest(flat)
+        progress = self.arc_length[segment] + t * self.segment_length[segment]
+        tangent = self.tangents[segment]
+        relative = flat - self.points[segment]
+        lateral_offset = tangent[:, 0] * relative[:, 1] - tangent[:, 1] * relative[:, 0]
+
+        shape = positions.shape[:-1]
+        return progress.reshape(shape), lateral_offset.reshape(shape), segment.reshape(shape)
+
+
+    def width_at(self, segment, t):
+        """Returns the (left, right) widths at position t along the segments."""
+        left = self.width_left[segment] + t * (self.width_left[segment + 1] - self.width_left[segment])
+        right = self.width_right[segment] + t * (self.width_right[segment + 1] - self.width_right[segment])
+        return left, right
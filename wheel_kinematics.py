@@ -0,0 +1,55 @@
+import numpy as np
+
+
+class WheelKinematics:
+    """Kinematics of all wheels of a rigid body at once.
+
+    The wheel positions are fixed in the body frame, so their lever arms are
+    precomputed and every quantity is evaluated for all wheels in one
+    vectorized call. Body velocities, yaw rates and steering angles may carry
+    leading batch dimensions (one per environment); the per-wheel results
+    have shape (..., n_wheels, 2) and per-wheel scalars (..., n_wheels).
+
+    tire_force(slip_vel) maps (..., n_wheels, 2) slip velocities to tire
+    forces of the same shape.
+    """
+
+    def __init__(self, positions, wheel_radius, steered, tire_force=None) -> None:
+        self.positions = np.asarray(positions, dtype=float)
+        # Velocity of each wheel per unit yaw rate: rotate90(position)
+        self.lever = np.stack([-self.positions[:, 1], self.positions[:, 0]], axis=-1)
+        self.wheel_radius = wheel_radius
+        self.steered = np.asarray(steered, dtype=bool)
+        self.tire_force = tire_force
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    def center_velocity(self, body_vel, yaw_rate):
+        """Velocity of every wheel center in the body frame."""
+        body_vel = np.asarray(body_vel)
+        yaw_rate = np.asarray(yaw_rate)
+        return body_vel[..., None, :] + yaw_rate[..., None, None] * self.lever
+
+
+    def heading(self, steering_angle):
+        """Unit rolling direction of every wheel in the body frame."""
+        steering = np.where(self.steered, np.asarray(steering_angle)[..., None], 0)
+        return np.stack([np.cos(steering), -np.sin(steering)], axis=-1)
+
+
+    def slip_velocity(self, body_vel, yaw_rate, wheel_speed, steering_angle):
+        """Velocity of every contact point relative to the ground."""
+        rolling_speed = np.asarray(wheel_speed) * self.wheel_radius
+        return (
+            self.center_velocity(body_vel, yaw_rate)
+            - self.heading(steering_angle) * rolling_speed[..., None]
+        )
+
+
+    def tire_forces(self, body_vel, yaw_rate, wheel_speed, steering_angle):
+        """Tire force on every wheel, from the slip velocity of its contact point."""
+        slip_vel = self.slip_velocity(body_vel, yaw_rate, wheel_speed, steering_angle)
+        return self.tire_force(slip_vel)